@@ -0,0 +1,488 @@
+"""Performance benchmarks for SafeKid Messenger
+
+Run one benchmark at a time, e.g. ``python benchmarks.py startup``.
+"""
+import argparse
+import os
+import random
+import re
+import sqlite3
+import statistics
+import string
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import content_filter
+import database
+
+
+def _timed(fn, repeat):
+    """Run fn repeat times and return the individual timings in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _report(label, timings):
+    print(f"{label:<32} min {min(timings):9.3f} ms   median {statistics.median(timings):9.3f} ms")
+
+
+def _populate(conn, messages, users=200):
+    """Fill a freshly migrated database with users and chat history"""
+    conn.executemany(
+        "INSERT INTO users (username, password, is_parent, parent_id) VALUES (?, ?, ?, ?)",
+        ((f"user{i}", "x" * 64, int(i < users // 10), None if i < users // 10 else i % (users // 10) + 1)
+         for i in range(users)))
+    start = datetime(2025, 1, 1)
+    last_seq = {}
+    keys = content_filter.ContentFilter(normalize=False)
+
+    def rows():
+        for i in range(messages):
+            sender, receiver = i % users + 1, (i * 7) % users + 1
+            pair = (min(sender, receiver), max(sender, receiver))
+            last_seq[pair] = seq = last_seq.get(pair, 0) + 1
+            sent = start + timedelta(seconds=i)
+            text = f"message number {i}"
+            yield (sender, receiver, text, sent.strftime("%Y-%m-%d %H:%M:%S"),
+                   i % 3 != 0, i % 3 != 0, int(sent.timestamp() * 1_000_000), seq, 0,
+                   content_filter.signature(text), keys.content_key(sender, receiver, text), sender, receiver)
+
+    conn.executemany(database.INSERT_MESSAGE_SQL, rows())
+    conn.executemany("INSERT INTO conversations (user_low, user_high, last_seq) VALUES (?, ?, ?)",
+                     ((low, high, seq) for (low, high), seq in last_seq.items()))
+    conn.commit()
+
+
+def bench_startup(args):
+    """Compare schema startup cost on an empty and on a populated database"""
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, rows in (("empty database", 0), (f"{args.messages:,} messages", args.messages)):
+            path = os.path.join(tmp, f"startup_{rows}.db")
+            conn = sqlite3.connect(path)
+            database.migrate(conn)
+            if rows:
+                _populate(conn, rows)
+            conn.close()
+
+            def startup():
+                conn = sqlite3.connect(path)
+                database.migrate(conn)
+                conn.close()
+
+            _report(label, _timed(startup, args.repeat))
+
+
+def _send_concurrently(writer, clients, writes):
+    """Insert writes messages from clients threads and return messages per second"""
+    per_client = writes // clients
+
+    def client(n):
+        for i in range(per_client):
+            database.insert_message(writer, n % 50 + 1, (n + i) % 50 + 51, f"hello {i}", 0, 0)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_client * clients / (time.perf_counter() - start)
+
+
+def bench_group_commit(args):
+    """Compare commit-per-message with the group-commit WriteQueue"""
+    with tempfile.TemporaryDirectory() as tmp:
+        for durability in ("full", "normal"):
+            for queued in (False, True):
+                path = os.path.join(tmp, f"writes_{durability}_{queued}.db")
+                conn = sqlite3.connect(path)
+                database.migrate(conn)
+                _populate(conn, 0, users=100)
+                conn.close()
+                db = database.Database(path, durability=durability)
+                writer = database.WriteQueue(db, max_delay=args.max_delay / 1000) if queued else db
+                rate = _send_concurrently(writer, args.clients, args.writes)
+                label = f"{durability:<6} {'group commit' if queued else 'commit each'}"
+                detail = f"   mean batch {writer.writes / writer.batches:6.1f}" if queued else ""
+                print(f"{label:<32} {rate:10,.0f} messages/s{detail}")
+                if queued:
+                    writer.close()
+                db.close()
+
+
+_CHAT_WORDS = ("hi", "ok", "lol", "gg", "are", "you", "online", "see", "at", "school", "tomorrow",
+               "my", "mom", "said", "we", "can", "play", "minecraft", "after", "homework", "what",
+               "time", "is", "it", "send", "me", "the", "link", "that", "was", "so", "funny", "haha",
+               "haste", "later", "skate", "bath", "hat", "date")
+
+
+def _make_terms(count, seed=1):
+    """Return count distinct pseudo-words, always including the default terms"""
+    rng = random.Random(seed)
+    terms = set(content_filter.DEFAULT_TERMS)
+    while len(terms) < count:
+        terms.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))))
+    return sorted(terms)
+
+
+def _make_corpus(count, terms, flagged=0.05, seed=2):
+    """Return count short chat messages, roughly a flagged fraction containing a term"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        words = [rng.choice(_CHAT_WORDS) for _ in range(rng.randint(1, 12))]
+        if rng.random() < flagged:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(terms))
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def _naive_filter(message, bad_words):
+    """The original filter_message loop, without the message box"""
+    for word in bad_words:
+        if word in message.lower():
+            message = message.replace(word, "***")
+            break
+    return message
+
+
+def bench_filter(args):
+    """Filter throughput at 10, 1k and 50k dictionary terms"""
+    for count in (10, 1_000, 50_000):
+        terms = _make_terms(count)
+        corpus = _make_corpus(args.corpus, terms)
+        chars = sum(map(len, corpus))
+        start = time.perf_counter()
+        automaton = content_filter.Automaton(terms)
+        build = time.perf_counter() - start
+        print(f"{count:>6,} terms: {automaton.states:,} states, {automaton.nbytes / 2**20:.1f} MiB, "
+              f"built in {build * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        for message in corpus:
+            content_filter.mask(message, automaton.find(message))
+        elapsed = time.perf_counter() - start
+        print(f"    automaton   {len(corpus) / elapsed:12,.0f} messages/s {chars / elapsed / 2**20:8.2f} MiB/s")
+
+        sample = corpus[:max(1, args.corpus * 10 // count)]
+        start = time.perf_counter()
+        for message in sample:
+            _naive_filter(message, terms)
+        elapsed = time.perf_counter() - start
+        print(f"    naive loop  {len(sample) / elapsed:12,.0f} messages/s "
+              f"{sum(map(len, sample)) / elapsed / 2**20:8.2f} MiB/s")
+
+
+def _obfuscate(message, rng):
+    """Disguise a message the way kids do: leetspeak, full-width, zero-width, accents"""
+    trick = rng.randrange(4)
+    if trick == 0:
+        return message.replace("a", "4").replace("e", "3")
+    if trick == 1:
+        return "".join(chr(ord(c) + 0xFEE0) if "!" <= c <= "~" else c for c in message)
+    if trick == 2:
+        return "\u200d".join(message)
+    return "".join(c + "\u0301" if c in "aeiou" else c for c in message)
+
+
+def bench_normalize(args):
+    """Cost of the normalization stage next to the raw filter"""
+    terms = content_filter.DEFAULT_TERMS
+    plain = _make_corpus(args.corpus, terms)
+    rng = random.Random(3)
+    disguised = [_obfuscate(message, rng) for message in plain]
+    raw = content_filter.ContentFilter(terms, normalize=False)
+    normalized = content_filter.ContentFilter(terms)
+    cases = (
+        ("original filter_message loop", lambda m: _naive_filter(m, terms) != m),
+        ("automaton, no normalization", lambda m: bool(raw.filter(m)[1])),
+        ("normalize + automaton", lambda m: bool(normalized.filter(m)[1])),
+    )
+    for corpus_label, corpus in (("plain", plain), ("disguised", disguised)):
+        for label, fn in cases:
+            start = time.perf_counter()
+            flagged = sum(map(fn, corpus))
+            elapsed = time.perf_counter() - start
+            print(f"{corpus_label:<10} {label:<30} {len(corpus) / elapsed:10,.0f} messages/s"
+                  f"   flagged {flagged:,}")
+
+
+def bench_prefilter(args):
+    """Bloom prefilter: measured false-positive rates and end-to-end filter throughput"""
+    rng = random.Random(5)
+    for count in (10, 1_000, 50_000):
+        terms = _make_terms(count)
+        corpus = _make_corpus(args.corpus, terms)
+        plain = content_filter.ContentFilter(terms)
+        start = time.perf_counter()
+        flagged = sum(bool(plain.filter(message)[1]) for message in corpus)
+        baseline = len(corpus) / (time.perf_counter() - start)
+        print(f"{count:>6,} terms: no prefilter {baseline:10,.0f} messages/s   flagged {flagged:,}")
+        for fp in (0.01, 0.001, 0.0001):
+            content = content_filter.ContentFilter(terms, prefilter=fp)
+            prefilter = content.automaton.prefilter
+            probes = {"".join(rng.choice(string.ascii_lowercase) for _ in range(4)) for _ in range(20_000)}
+            probes -= {prefilter.pick(term, 4) for term in terms}
+            gram_fp = sum(probe in prefilter.bloom for probe in probes) / len(probes)
+            passed = sum(map(prefilter.may_match, corpus)) / len(corpus)
+            start = time.perf_counter()
+            same = sum(bool(content.filter(message)[1]) for message in corpus) == flagged
+            rate = len(corpus) / (time.perf_counter() - start)
+            print(f"    fp {fp:<7} {prefilter.nbytes / 1024:8.1f} KiB   n-gram fp {gram_fp:7.3%}"
+                  f"   passed {passed:6.1%}   {rate:10,.0f} messages/s   x{rate / baseline:.2f}"
+                  f"{'' if same else '   MISSED HITS'}")
+
+
+def _make_chatter(count, terms, seed=6):
+    """Return count messages in which short phrases repeat the way real chat does (Zipf-like)"""
+    rng = random.Random(seed)
+    phrases = _make_corpus(5_000, terms, seed=seed)
+    weights = [1 / (rank + 1) for rank in range(len(phrases))]
+    return rng.choices(phrases, weights, k=count)
+
+
+def bench_cache(args):
+    """Verdict cache hit rate and throughput on repetitive chat"""
+    terms = _make_terms(1_000)
+    corpus = _make_chatter(args.corpus, terms)
+    for size in (0, 1_000, 10_000):
+        content = content_filter.ContentFilter(terms, fuzzy=True, cache_size=size)
+        content.wait_ready()
+        start = time.perf_counter()
+        flagged = sum(bool(content.filter(message)[1]) for message in corpus)
+        rate = len(corpus) / (time.perf_counter() - start)
+        hits = f"hit rate {content.cache.hit_rate:6.1%}" if size else "no cache       "
+        print(f"cache {size:>6,}   {hits}   {rate:10,.0f} messages/s   flagged {flagged:,}")
+
+
+def bench_overlays(args):
+    """Memory per family and scan cost of per-family word lists over a shared dictionary"""
+    base_terms = _make_terms(50_000)
+    families = {family: _make_terms(20, seed=100 + family)[len(content_filter.DEFAULT_TERMS):]
+                for family in range(1_000)}
+    content = content_filter.ContentFilter(base_terms, family_terms=families.__getitem__)
+    for family in families:
+        content.overlays.get(family)
+    sizes = content.overlays.nbytes()
+    print(f"shared dictionary {content.automaton.nbytes / 2**20:.1f} MiB; {len(sizes):,} families loaded, "
+          f"{statistics.mean(sizes.values()) / 1024:.1f} KiB each, {sum(sizes.values()) / 2**20:.1f} MiB total")
+
+    corpus = _make_corpus(args.corpus, base_terms)
+    for label, picked in (("shared only", ()), ("shared + 1 family", (1,)), ("shared + 2 families", (1, 2))):
+        start = time.perf_counter()
+        for message in corpus:
+            content.filter(message, picked)
+        print(f"    {label:<22} {len(corpus) / (time.perf_counter() - start):10,.0f} messages/s")
+
+
+def bench_pii(args):
+    """Cost of PII detection: one alternation vs one regex per kind, next to the term filter"""
+    rng = random.Random(8)
+    extras = ("call me 555-123-4567", "i live at 42 maple street", "mail me kid@example.com",
+              "i go to lincoln elementary school")
+    corpus = [message + " " + rng.choice(extras) if rng.random() < 0.05 else message
+              for message in _make_corpus(args.corpus, content_filter.DEFAULT_TERMS)]
+    content = content_filter.ContentFilter()
+    separate = [re.compile(pattern, content_filter.PII_PATTERN.flags) for pattern in content_filter.PII_PARTS.values()]
+    cases = (
+        ("term filter only", lambda m: content.filter(m)),
+        ("one regex per PII kind", lambda m: [match for regex in separate for match in regex.finditer(m)]),
+        ("single PII alternation", content_filter.find_pii),
+        ("inspect (terms + PII)", content.inspect),
+    )
+    for label, fn in cases:
+        start = time.perf_counter()
+        for message in corpus:
+            fn(message)
+        print(f"{label:<26} {len(corpus) / (time.perf_counter() - start):10,.0f} messages/s")
+
+
+def bench_links(args):
+    """Allowlist lookups stay flat as the list grows; link extraction cost per message"""
+    rng = random.Random(9)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    hosts = [f"www.{''.join(rng.choices(letters, k=8))}.{rng.choice(('com', 'org', 'io'))}" for _ in range(10_000)]
+    for size in (100, 10_000, 100_000):
+        entries = [f"{''.join(rng.choices(letters, k=rng.randint(4, 12)))}.{rng.choice(('com', 'org', 'net'))}"
+                   for _ in range(size)]
+        trie = content_filter.DomainTrie(entries + hosts[::2])
+        _report(f"10k lookups, {size:,} entries", _timed(lambda: [host in trie for host in hosts], args.repeat))
+        print(f"{'':<32} {trie.nbytes / 1024 ** 2:.1f} MiB")
+    corpus = [message + f" check https://{rng.choice(hosts)}/watch?v=1" if rng.random() < 0.05 else message
+              for message in _make_corpus(args.corpus, content_filter.DEFAULT_TERMS)]
+    content = content_filter.ContentFilter(allowed_domains=hosts[::2])
+    for label, fn in (("term filter only", content.filter), ("held links", content.held_links)):
+        start = time.perf_counter()
+        for message in corpus:
+            fn(message)
+        print(f"{label:<26} {len(corpus) / (time.perf_counter() - start):10,.0f} messages/s")
+
+
+def bench_conversation_risk(args):
+    """Per-message cost of the conversation warning-sign detector, independent of history length"""
+    corpus = _make_corpus(args.corpus, content_filter.DEFAULT_TERMS)
+    detector = content_filter.ConversationRisk()
+    start = time.perf_counter()
+    signals = [content_filter.risk_signals(message) for message in corpus]
+    print(f"{'warning signs':<26} {len(corpus) / (time.perf_counter() - start):10,.0f} messages/s")
+    for history in (10, 10_000):
+        state = None
+        for bits in signals[:history]:
+            state, _ = detector.observe(state, bits)
+        start = time.perf_counter()
+        for bits in signals:
+            state, _ = detector.observe(state, bits)
+        elapsed = time.perf_counter() - start
+        print(f"{f'window update after {history:,}':<26} {elapsed / len(signals) * 1e6:10.2f} us/message")
+
+
+def bench_near_duplicates(args):
+    """Signature cost per send, and grouping a review queue full of repeats"""
+    rng = random.Random(10)
+    repeats = ("are you online??", "ARE YOU ONLINE", "are you online?!", "hello??", "hellooo", "can you play now")
+    corpus = _make_corpus(args.corpus, content_filter.DEFAULT_TERMS)
+    _report(f"sign {len(corpus):,} messages", _timed(lambda: list(map(content_filter.signature, corpus)), args.repeat))
+    for size in (100, 1_000, 10_000):
+        queue = [rng.choice(repeats) if rng.random() < 0.5 else rng.choice(corpus) for _ in range(size)]
+        signatures = list(map(content_filter.signature, queue))
+        groups = content_filter.near_duplicates(signatures)
+        _report(f"group {size:,} pending ({len(groups):,} groups)",
+                _timed(lambda: content_filter.near_duplicates(signatures), args.repeat))
+
+
+def bench_risk(args):
+    """Risk model training time and batch scoring speed (needs NumPy)"""
+    import risk
+
+    corpus = _make_corpus(args.corpus, content_filter.DEFAULT_TERMS)
+    rng = random.Random(7)
+    labels = [rng.random() < 0.1 for _ in corpus]
+    start = time.perf_counter()
+    model = risk.RiskModel.seeded(corpus, labels)
+    print(f"trained on {len(corpus):,} messages in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for batch in (100, 10_000, 100_000):
+        texts = (corpus * (batch // len(corpus) + 1))[:batch]
+        _report(f"score {batch:,} messages", _timed(lambda: model.score(texts), args.repeat))
+
+
+def _misspell(term, rng):
+    """Return term with one typo kids make: a doubled letter, a swapped vowel or a dropped letter"""
+    i = rng.randrange(len(term))
+    typo = rng.randrange(3)
+    if typo == 0:
+        return term[:i] + term[i] + term[i:]
+    if typo == 1 and term[i] in "aeiou":
+        return term[:i] + rng.choice("aeiou".replace(term[i], "")) + term[i + 1:]
+    return term[:i] + term[i + 1:] if len(term) > 5 else term + term[-1]
+
+
+def bench_fuzzy(args):
+    """Fuzzy matcher index size, build time, worst-case lookup and recall of misspellings"""
+    rng = random.Random(4)
+    for count in (1_000, 50_000):
+        terms = _make_terms(count)
+        start = time.perf_counter()
+        matcher = content_filter.FuzzyMatcher(terms)
+        build = time.perf_counter() - start
+        print(f"{count:>6,} terms: distance {matcher.max_distance}, {len(matcher.index):,} deletes, "
+              f"{matcher.nbytes / 2**20:.1f} MiB, built in {build * 1000:.0f} ms")
+        print(f"    worst case {matcher.worst_case_probes} probes x {matcher.largest_bucket} candidates per token")
+
+        corpus = _make_corpus(args.corpus, terms)
+        tokens = [word for message in corpus for word in message.split()]
+        timings = []
+        for token in tokens:
+            start = time.perf_counter()
+            matcher.match(token)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"    {len(tokens) / sum(timings):10,.0f} tokens/s   p99 {timings[len(timings) * 99 // 100] * 1e6:7.1f} us"
+              f"   max {timings[-1] * 1e6:7.1f} us")
+
+        candidates = [term for term in terms if len(term) >= 6]
+        sample = rng.sample(candidates, min(2000, len(candidates)))
+        typos = [_misspell(term, rng) for term in sample]
+        caught = sum(matcher.match(typo) is not None for typo in typos)
+        clean = sum(matcher.match(word) is not None for word in _CHAT_WORDS)
+        print(f"    caught {caught / len(typos):6.1%} of misspelled terms, {clean} of {len(_CHAT_WORDS)} chat words flagged")
+
+
+def bench_snapshot(args):
+    """Startup cost of a large dictionary: compile from the word list vs map a snapshot"""
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in (1_000, 50_000):
+            source = os.path.join(tmp, f"terms_{count}.txt")
+            with open(source, "w", encoding="utf-8") as f:
+                f.write("\n".join(_make_terms(count)))
+            with open(source, "rb") as f:
+                raw = f.read()
+            terms = content_filter.parse_terms(raw.decode("utf-8"))
+            dictionary = content_filter.Dictionary(source, normalizer=content_filter.Normalizer())
+            automaton = dictionary.load()
+            size = os.path.getsize(dictionary.snapshot_path(raw))
+            print(f"{count:>6,} terms: {automaton.states:,} states, snapshot {size / 2**20:.1f} MiB")
+            _report("    compile", _timed(lambda: content_filter.Automaton(terms), max(1, args.repeat // 10)))
+            _report("    map snapshot", _timed(dictionary.load, args.repeat))
+            start = time.perf_counter()
+            content = content_filter.ContentFilter(dictionary=source, fuzzy=True)
+            ready = time.perf_counter() - start
+            content.wait_ready()
+            print(f"    filter with fuzzy matching usable after {ready * 1000:.1f} ms, "
+                  f"fuzzy index ready after {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def bench_batch(args):
+    """filter_batch() throughput and chunk latency, in process and across worker processes"""
+    corpus = _make_corpus(args.corpus * 10, content_filter.DEFAULT_TERMS)
+    content = content_filter.ContentFilter()
+    for workers in (0, 2, os.cpu_count() or 1):
+        stats = content_filter.BatchStats()
+        flagged = 0
+        for results in content_filter.filter_batch(corpus, content, args.chunk_size, workers, stats):
+            flagged += sum(1 for _, spans in results if spans)
+        label = f"{workers} workers" if workers else "in process"
+        print(f"{label:<12} {stats.throughput:10,.0f} messages/s   chunk p50 {stats.latency(0.5) * 1000:7.2f} ms"
+              f"   p95 {stats.latency(0.95) * 1000:7.2f} ms   flagged {flagged:,}")
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "group-commit": bench_group_commit,
+    "batch": bench_batch,
+    "cache": bench_cache,
+    "conversation-risk": bench_conversation_risk,
+    "filter": bench_filter,
+    "fuzzy": bench_fuzzy,
+    "links": bench_links,
+    "near-duplicates": bench_near_duplicates,
+    "prefilter": bench_prefilter,
+    "risk": bench_risk,
+    "normalize": bench_normalize,
+    "pii": bench_pii,
+    "overlays": bench_overlays,
+    "snapshot": bench_snapshot,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--messages", type=int, default=2_000_000, help="rows in the populated database")
+    parser.add_argument("--repeat", type=int, default=20, help="timed repetitions per case")
+    parser.add_argument("--corpus", type=int, default=20_000, help="messages in filter benchmarks")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="messages per filter_batch chunk")
+    parser.add_argument("--writes", type=int, default=20_000, help="messages sent in write benchmarks")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent writers")
+    parser.add_argument("--max-delay", type=float, default=5.0, help="group-commit latency budget in ms")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
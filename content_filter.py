@@ -0,0 +1,1313 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, count, islice, repeat
+from operator import add, mod
+from zlib import crc32
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TERMS = ("bad", "hate", "stupid")  # Should be more comprehensive in production
+
+MASK = "***"
+
+# Snapshot header: magic, format, width, states, classes, outputs, terms, term bytes.
+# Tables are stored in native byte order; snapshots are a local cache, not an exchange format.
+SNAPSHOT_MAGIC = b"SKAC"
+SNAPSHOT_FORMAT = 1
+_HEADER = struct.Struct("=4s7I")
+
+
+class Automaton:
+    """Aho-Corasick matcher compiled to a dense DFA
+
+    Characters are folded into classes (one per character used by the terms,
+    both cases, plus 0 for everything else) and every state stores a full
+    transition row, so scanning is one table lookup per character with no
+    failure-link chasing. The tables are flat arrays: memory is about
+    4 * states * (classes + 1) bytes.
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted({term.lower() for term in terms if term})
+        self.classes = {}
+        for term in self.terms:
+            for ch in term:
+                if ch not in self.classes:
+                    self.classes[ch] = len(self.classes) + 1
+        for ch, cls in list(self.classes.items()):
+            upper = ch.upper()
+            if len(upper) == 1 and upper not in self.classes:
+                self.classes[upper] = cls
+        self.width = len(set(self.classes.values())) + 1
+        self._build()
+
+    def _build(self):
+        width = self.width
+        classes = self.classes
+
+        # Trie of the terms: goto[state] maps class -> child state
+        goto = [{}]
+        accepts = [[]]
+        for index, term in enumerate(self.terms):
+            state = 0
+            for ch in term:
+                cls = classes[ch]
+                child = goto[state].get(cls)
+                if child is None:
+                    child = len(goto)
+                    goto[state][cls] = child
+                    goto.append({})
+                    accepts.append([])
+                state = child
+            accepts[state].append(index)
+
+        # Breadth-first: each state's row starts as a copy of its failure
+        # state's row, which is complete because it is shallower.
+        delta = array("i", bytes(4 * width * len(goto)))
+        fail = [0] * len(goto)
+        order = deque()
+        for cls, child in goto[0].items():
+            delta[cls] = child
+            order.append(child)
+        while order:
+            state = order.popleft()
+            accepts[state].extend(accepts[fail[state]])
+            row = state * width
+            failed = fail[state] * width
+            delta[row:row + width] = delta[failed:failed + width]
+            for cls, child in goto[state].items():
+                fail[child] = delta[failed + cls]
+                delta[row + cls] = child
+                order.append(child)
+
+        self.delta = delta
+        self.accepting = bytes(bool(terms) for terms in accepts)
+        self.output_start = array("i", [0])
+        self.output_terms = array("i")
+        for terms in accepts:
+            self.output_terms.extend(terms)
+            self.output_start.append(len(self.output_terms))
+        self.term_lengths = array("i", (len(term) for term in self.terms))
+
+    @property
+    def states(self):
+        return len(self.accepting)
+
+    @property
+    def nbytes(self):
+        """Approximate size of the compiled tables"""
+        return (self.delta.itemsize * len(self.delta) + len(self.accepting)
+                + self.output_start.itemsize * len(self.output_start)
+                + self.output_terms.itemsize * len(self.output_terms))
+
+    def save(self, path):
+        """Write the compiled tables to path as a snapshot that load() can map"""
+        classes = array("i")
+        for ch, cls in self.classes.items():
+            classes.extend((ord(ch), cls))
+        names = "\n".join(self.terms).encode("utf-8")
+        header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, self.width, self.states, len(self.classes),
+                              len(self.output_terms), len(self.terms), len(names))
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(partial, "wb") as f:
+            f.write(header)
+            for table in (classes, self.delta, self.output_start, self.output_terms, self.term_lengths):
+                f.write(table)
+            f.write(self.accepting)
+            f.write(names)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        """Map a snapshot written by save(), without rebuilding anything
+
+        The tables are memoryviews over the mapping, so they are shared with
+        the page cache and the file stays mapped for as long as they live.
+        """
+        with open(path, "rb") as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        if len(view) < _HEADER.size:
+            raise ValueError(f"{path} is not a filter snapshot")
+        magic, version, width, states, pairs, outputs, count, names = _HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} is not a filter snapshot")
+        sizes = (2 * pairs, states * width, states + 1, outputs, count)
+        offset = _HEADER.size
+        if len(view) != offset + 4 * sum(sizes) + states + names:
+            raise ValueError(f"{path} is truncated")
+        tables = []
+        for size in sizes:
+            tables.append(view[offset:offset + 4 * size].cast("i"))
+            offset += 4 * size
+        classes, delta, output_start, output_terms, term_lengths = tables
+
+        self = cls.__new__(cls)
+        self.classes = {chr(classes[i]): classes[i + 1] for i in range(0, len(classes), 2)}
+        self.width = width
+        self.delta = delta
+        self.accepting = view[offset:offset + states]
+        self.output_start = output_start
+        self.output_terms = output_terms
+        self.term_lengths = term_lengths
+        self.terms = bytes(view[offset + states:]).decode("utf-8").split("\n") if count else []
+        return self
+
+    def find(self, text):
+        """Return (start, end, term) for every occurrence of every term in text"""
+        delta = self.delta
+        width = self.width
+        accepting = self.accepting
+        get = self.classes.get
+        spans = []
+        state = 0
+        for i, ch in enumerate(text):
+            state = delta[state * width + get(ch, 0)]
+            if accepting[state]:
+                end = i + 1
+                for k in range(self.output_start[state], self.output_start[state + 1]):
+                    term = self.output_terms[k]
+                    spans.append((end - self.term_lengths[term], end, self.terms[term]))
+        return spans
+
+    def emit(self, state, end, spans):
+        """Append the spans of the terms accepted in state, ending at end"""
+        for k in range(self.output_start[state], self.output_start[state + 1]):
+            term = self.output_terms[k]
+            spans.append((end - self.term_lengths[term], end, self.terms[term]))
+
+
+def find_layered(text, automata):
+    """Like Automaton.find for several automata, stepped together in one pass over text"""
+    if len(automata) == 1:
+        return automata[0].find(text)
+    if len(automata) == 2:
+        # The common case, a shared dictionary and one family, without the inner loop
+        first, second = automata
+        delta1, width1, accepting1, get1 = first.delta, first.width, first.accepting, first.classes.get
+        delta2, width2, accepting2, get2 = second.delta, second.width, second.accepting, second.classes.get
+        spans = []
+        state1 = state2 = 0
+        for i, ch in enumerate(text):
+            state1 = delta1[state1 * width1 + get1(ch, 0)]
+            state2 = delta2[state2 * width2 + get2(ch, 0)]
+            if accepting1[state1]:
+                first.emit(state1, i + 1, spans)
+            if accepting2[state2]:
+                second.emit(state2, i + 1, spans)
+        return spans
+    layers = [(a.delta, a.width, a.accepting, a.classes.get, a) for a in automata]
+    states = [0] * len(layers)
+    spans = []
+    for i, ch in enumerate(text):
+        for n, (delta, width, accepting, get, automaton) in enumerate(layers):
+            state = states[n] = delta[states[n] * width + get(ch, 0)]
+            if accepting[state]:
+                automaton.emit(state, i + 1, spans)
+    return spans
+
+
+def mask(text, spans, replacement=MASK):
+    """Replace every span of text with replacement, merging overlaps
+
+    The result is built with one join however many spans there are.
+    """
+    if not spans:
+        return text
+    pieces = []
+    position = 0
+    for start, end, *_ in sorted(spans):
+        if start > position or not pieces:
+            pieces.append(text[position:start])
+            pieces.append(replacement)
+        position = max(position, end)
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+
+# Look-alike characters folded onto the letters they imitate
+LEET = {
+    "0": "o",
+    "1": "i",
+    "!": "i",
+    "3": "e",
+    "4": "a",
+    "@": "a",
+    "5": "s",
+    "$": "s",
+    "7": "t",
+    "+": "t",
+}
+
+
+def fold_character(ch):
+    """Return the matching form of one character, possibly empty or longer
+
+    Format characters such as zero-width joiners disappear, compatibility
+    forms (full-width letters, ligatures) are decomposed NFKC-style, accents
+    and other combining marks are dropped, and the rest is case-folded and
+    passed through LEET.
+    """
+    if unicodedata.category(ch) == "Cf":
+        return ""
+    decomposed = unicodedata.normalize("NFKD", ch)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return "".join(LEET.get(c, c) for c in folded)
+
+
+class _FoldTable(dict):
+    """str.translate table that fills itself in on first sight of a character"""
+
+    def __init__(self):
+        super().__init__()
+        self.irregular = set()  # Characters that fold to zero or several characters
+
+    def __missing__(self, codepoint):
+        folded = fold_character(chr(codepoint))
+        if len(folded) != 1:
+            self.irregular.add(chr(codepoint))
+        self[codepoint] = folded
+        return folded
+
+
+class Normalizer:
+    """Folds text into the form the matchers see, in one translate() pass
+
+    normalize() returns the folded text and an offset map from each folded
+    character back to the original character it came from, so spans found
+    in the folded text can be masked in the original. When every character
+    folds to exactly one character the map is None: offsets are unchanged.
+    """
+
+    def __init__(self):
+        self.table = _FoldTable()
+        # Precompute the common ranges: ASCII, Latin-1 and the full-width forms
+        for codepoint in (*range(0x00, 0x250), *range(0xFF01, 0xFF5F), 0x200B, 0x200C, 0x200D, 0x2060, 0xFEFF):
+            self.table[codepoint]
+
+    def normalize(self, text):
+        """Return (folded text, offsets or None)"""
+        table = self.table
+        folded = text.translate(table)
+        if table.irregular.isdisjoint(text):
+            return folded, None
+        offsets = []
+        for i, ch in enumerate(text):
+            offsets.extend([i] * len(table[ord(ch)]))
+        return folded, offsets
+
+
+def to_original(spans, offsets):
+    """Map (start, end, ...) spans over folded text back onto the original text"""
+    if offsets is None:
+        return spans
+    return [(offsets[start], offsets[end - 1] + 1, *rest) for start, end, *rest in spans]
+
+
+# Squeezed length from which 1 and 2 edits are allowed. Five-letter words are too often one
+# edit from a short term ("haste", "hate") to allow any.
+FUZZY_DISTANCES = ((6, 1), (9, 2))
+
+FUZZY_MEMORY_BUDGET = 64 * 2**20
+
+_WORD = re.compile(r"[^\W\d_]+")
+_REPEATS = re.compile(r"(.)\1+")
+
+
+def _collapse(word):
+    """Squeeze runs of a letter to one, so "haaate" and "stooopid" count as one edit at most"""
+    return _REPEATS.sub(r"\1", word)
+
+
+def _deletes(word, depth):
+    """Return word and every string made by deleting up to depth of its characters"""
+    found = {word}
+    layer = {word}
+    for _ in range(depth):
+        layer = {w[:i] + w[i + 1:] for w in layer for i in range(len(w))}
+        found |= layer
+    return found
+
+
+def _distance(a, b, limit):
+    """Return the Levenshtein distance of a and b, or None if it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class FuzzyMatcher:
+    """Flags whole words within a small edit distance of a term (SymSpell-style)
+
+    Every term, with letter runs squeezed, is indexed under each string
+    made by deleting up to max_distance of its characters. A token is
+    squeezed the same way and looked up under its own deletes, so finding
+    the terms within d edits never compares against the whole dictionary.
+    How many edits a token may have depends on its length (FUZZY_DISTANCES).
+
+    Worst case per token: tokens longer than the longest term plus the
+    distance are skipped, so a token has L <= longest + max_distance
+    letters and at most worst_case_probes deletes (1 + L + L(L-1)/2 for
+    two edits). Each probe returns at most largest_bucket terms, and each
+    distinct candidate costs one O(L^2) distance check.
+
+    The index is about 30 bytes per delete plus the strings themselves.
+    If building it at max_distance would pass memory_budget it is built
+    with one edit fewer, and ValueError is raised if not even exact
+    squeezed matching fits. A depth whose estimated size (every delete
+    counted as distinct) is over the budget is skipped without building.
+    """
+
+    def __init__(self, terms, max_distance=2, distances=FUZZY_DISTANCES, memory_budget=FUZZY_MEMORY_BUDGET):
+        self.terms = sorted({term.lower() for term in terms if _WORD.fullmatch(term)})
+        self.keys = [_collapse(term) for term in self.terms]
+        self.longest = max(map(len, self.keys), default=0)
+        for depth in range(max_distance, -1, -1):
+            if depth and self._estimate(depth) > memory_budget:
+                continue
+            index = self._build(depth, memory_budget)
+            if index is not None:
+                break
+        else:
+            raise ValueError(f"fuzzy index for {len(self.terms):,} terms exceeds {memory_budget:,} bytes")
+        self.index = index
+        self.max_distance = depth
+        self.distances = tuple((length, min(edits, depth)) for length, edits in distances)
+
+    def _estimate(self, depth):
+        # Upper bound on deletes, at the per-delete cost _build() counts for a short string
+        deletes = sum(math.comb(len(key), k) for key in self.keys for k in range(depth + 1))
+        return deletes * (sys.getsizeof("") + 8 + sys.getsizeof([]) + 24 + 8)
+
+    def _build(self, depth, budget):
+        index = {}
+        nbytes = sys.getsizeof(index)
+        for number, key in enumerate(self.keys):
+            for variant in _deletes(key, depth):
+                bucket = index.get(variant)
+                if bucket is None:
+                    index[variant] = bucket = []
+                    nbytes += sys.getsizeof(variant) + sys.getsizeof(bucket) + 24
+                bucket.append(number)
+                nbytes += 8
+            if nbytes > budget:
+                return None
+        self.nbytes = nbytes
+        return index
+
+    def allowance(self, length):
+        """Edits allowed for a squeezed token of this length"""
+        allowed = 0
+        for shortest, edits in self.distances:
+            if length >= shortest:
+                allowed = edits
+        return allowed
+
+    @property
+    def worst_case_probes(self):
+        """Most index lookups a single token can cost"""
+        length = self.longest + self.max_distance
+        return sum(math.comb(length, k) for k in range(self.max_distance + 1)) if self.keys else 0
+
+    @property
+    def largest_bucket(self):
+        """Most candidate terms a single lookup can return"""
+        return max(map(len, self.index.values()), default=0)
+
+    def match(self, token):
+        """Return the closest term to token within its allowance, or None"""
+        key = _collapse(token.lower())
+        limit = self.allowance(len(key))
+        if len(key) > self.longest + limit:
+            return None
+        best = None
+        seen = set()
+        for variant in _deletes(key, limit):
+            for number in self.index.get(variant, ()):
+                if number in seen:
+                    continue
+                seen.add(number)
+                distance = _distance(key, self.keys[number], limit)
+                if distance is not None and (best is None or distance < best[0]):
+                    best = (distance, number)
+        return None if best is None else self.terms[best[1]]
+
+    def find(self, text):
+        """Return (start, end, term) for every word of text that fuzzily matches a term"""
+        spans = []
+        for word in _WORD.finditer(text):
+            term = self.match(word.group())
+            if term is not None:
+                spans.append((word.start(), word.end(), term))
+        return spans
+
+
+class BloomFilter:
+    """Approximate set: never misses a member, wrongly reports a non-member about fp of the time
+
+    Uses m one-byte slots and k salted hashes, sized for the number of items
+    with the usual m = -n ln(fp) / ln(2)^2 and k = m/n ln 2. A slot is a byte
+    rather than a bit so the membership test over many items at once runs
+    in C with map(); memory is m bytes. Python's string hash is randomized
+    per process, so a filter is rebuilt rather than stored.
+    """
+
+    def __init__(self, items, fp=0.001):
+        items = set(items)
+        n = max(1, len(items))
+        self.fp = fp
+        self.m = max(64, math.ceil(-n * math.log(fp) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / n * math.log(2)))
+        # Salting by appending a character keeps the k string hashes independent
+        self.salts = [chr(salt) for salt in range(self.k)]
+        slots = bytearray(self.m)
+        for item in items:
+            for salt in self.salts:
+                slots[hash(item + salt) % self.m] = 1
+        self.slots = bytes(slots)
+
+    def __contains__(self, item):
+        return self.any((item,))
+
+    def any(self, items):
+        """Return whether any of items may be a member"""
+        test = self.slots.__getitem__
+        for salt in self.salts:
+            items = list(compress(items, map(test, map(mod, map(hash, map(add, items, repeat(salt))), repeat(self.m)))))
+            if not items:
+                return False
+        return True
+
+
+# Letters from most to least common in English text, for picking a term's rarest n-gram
+_LETTER_RANK = {ch: rank for rank, ch in enumerate("etaoinshrdlcumwfgypbvkjxqz")}
+
+
+class Prefilter:
+    """Bloom filter over one n-gram of each term, to clear most messages before the automaton
+
+    A message containing a term contains every n-gram of it, so testing
+    just one per term, the one made of the rarest letters, is enough and
+    keeps common words like "what" from hitting "hate". Terms shorter than
+    n are stored whole. A message is passed on if any of its n-grams may be
+    in the filter; fp is the false-positive rate per n-gram tested, so a
+    message of L characters is passed needlessly about L * fp of the time.
+    """
+
+    def __init__(self, terms, fp=0.001, n=4):
+        grams = {self.pick(term, n) for term in terms if term}
+        self.bloom = BloomFilter(grams, fp)
+        self.lengths = sorted({len(gram) for gram in grams})
+
+    @staticmethod
+    def pick(term, n):
+        if len(term) <= n:
+            return term
+        grams = [term[i:i + n] for i in range(len(term) - n + 1)]
+        return max(grams, key=lambda gram: sum(_LETTER_RANK.get(ch, len(_LETTER_RANK)) for ch in gram))
+
+    @property
+    def nbytes(self):
+        return self.bloom.m
+
+    def may_match(self, text):
+        """Return False only if text certainly contains no term"""
+        for n in self.lengths:
+            count = len(text) - n + 1
+            if count > 0 and self.bloom.any(set(map(text.__getitem__, map(slice, range(count), range(n, count + n))))):
+                return True
+        return False
+
+
+# Street types, English and Turkish, written as a trie so a failed word costs one or two steps
+_STREET_TYPES = ("st(?:reet)?|r(?:oa)?d|av(?:e(?:nue)?)?|l(?:ane|n)|dr(?:ive)?|c(?:ourt|t|lose|rescent|ad(?:de)?|d)"
+                 "|b(?:oulevard|lvd)|way|pl(?:ace)?|terrace|s(?:okak|k)|mah(?:alle)?")
+
+# Pattern per kind of personal information, tried in this order at each position. Each
+# one can only start at a word boundary or on a digit, keeping the scan linear.
+PII_PARTS = {
+    "email": r"(?<![\w.+-])[\w.+-]+\s*(?:@|\(at\)|\[at\])\s*[\w-]+(?:\s*(?:\.|\(dot\)|\[dot\])\s*[\w-]+)+",
+    "phone": r"""(?<![\w+.-])(?:\+\d{1,3}[\s.-]?(?:\(\d{1,4}\)|\d{1,4})(?:[\s.-]?\d{2,4}){2,4}    # +90 532 123 45 67
+                |\(\d{3,4}\)\s?\d{3}[\s.-]?\d{2,4}(?:[\s.-]?\d{2})?                               # (555) 123-4567
+                |0?\d{3}(?P<sep>[\s.-])\d{3}(?P=sep)\d{4}                                         # 555-123-4567
+                |0\d{3}(?P<tsep>[\s.-]?)\d{3}(?P=tsep)\d{2}(?P=tsep)\d{2}                         # 0532 123 45 67
+                |\d{3}[.-]\d{4}|0\d{4}\s?\d{6}|\d{10,11})(?![\w-]|[.,]\d)""",
+    "address": rf"""\b\d{{1,5}}[a-z]?,?\s+(?:[a-z][\w'.-]*\s+){{1,3}}(?:{_STREET_TYPES})\b\.?
+                 |\b(?:{_STREET_TYPES})\.?\s+(?:no\.?\s*)?\d{{1,5}}\b""",
+    "school": r"""(?-i:\b(?:(?!(?:I|A|An|The|My|Our|Your|His|Her|Their|This|That|At|To|In|From|Hi|Hey|Love|Hate|
+                                  Like|No|New|Old|After|Before|Big|Best|Worst)\b)[A-Z][\w'.-]*\s+){1,4})
+                (?:(?:elementary|primary|middle|high|junior|senior|secondary|grammar)\s+)?(?:school|academy)\b
+                |\b(?:i\s+go\s+to|i\s+attend)\s+(?:[a-z][\w'.-]*\s+){0,3}
+                 (?:elementary|primary|middle|high|school|academy)\b""",
+}
+
+PII_KINDS = tuple(PII_PARTS)
+
+# Every kind in one alternation: the group that matched names the kind
+PII_PATTERN = re.compile("|".join(f"(?P<{kind}>{pattern})" for kind, pattern in PII_PARTS.items()),
+                         re.IGNORECASE | re.VERBOSE)
+
+
+def find_pii(text):
+    """Return (start, end, kind) for personal information in text, in one regex pass
+
+    This is a second pass over the message, separate from the blocked-term
+    scan, and no faster than one regex per kind (see `benchmarks.py pii`).
+    It cannot share the automaton's pass: that pass reads normalized text,
+    where digits and "@" are folded into letters, and the patterns need
+    them as typed. What the single alternation buys is one pass that names
+    the kind of each match.
+    """
+    return [(match.start(), match.end(), match.lastgroup) for match in PII_PATTERN.finditer(text)]
+
+
+# Top-level domains that mark a bare "name.tld" as a link; anything else needs a scheme or "www."
+LINK_TLDS = frozenset("""
+    com net org edu gov info biz io co me tv gg app dev xyz online site club live fun game games
+    ly ws link click top shop store blog page chat social uk ca au de fr nl tr ru
+""".split())
+
+URL_PATTERN = re.compile(r"""
+    (?<![\w@.+-])                                    # not inside an email address or a longer word
+    (?P<scheme>[a-z][a-z0-9+.-]*://)?
+    (?(scheme)(?:[^\s/\\?\#@<>"']*@)?)                # user:password@ goes before the real host
+    (?P<host>\[[0-9a-f:.]+\]|(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?
+             |(?<=[/@])[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)\.?     # a single label only right after a scheme
+    (?::\d{1,5})?
+    (?:[/\\?\#][^\s<>"']*)?                             # browsers read a backslash as a slash
+    """, re.IGNORECASE | re.VERBOSE)
+
+_IP_HOST = re.compile(r"\d{1,3}(?:\.\d{1,3}){3}|\[[0-9a-f:.]+\]")
+
+_TRAILING = ".,;:!?)]}'\""
+
+
+def find_urls(text):
+    """Return (start, end, host) for every link in text, host lower-cased
+
+    The host is the one a browser would visit: in "https://a.org@b.com/"
+    that is b.com. Without a scheme, only "www." hosts, hosts on a common
+    top-level domain and IP addresses count as links. Trailing punctuation
+    is left out of the span, so "see x.com." ends before the full stop.
+    """
+    urls = []
+    for match in URL_PATTERN.finditer(text):
+        host = match["host"].lower()
+        if not (match["scheme"] or host.startswith("www.") or host.rpartition(".")[2] in LINK_TLDS
+                or _IP_HOST.fullmatch(host)):
+            continue
+        end = match.start() + len(match[0].rstrip(_TRAILING))
+        urls.append((match.start(), max(end, match.end("host")), host))
+    return urls
+
+
+def domain_host(entry):
+    """Return the host an allowlist entry names, so "https://www.Example.com/x" allows example.com"""
+    entry = entry.strip().lower()
+    entry = entry.split("://", 1)[-1].split("/", 1)[0].rpartition("@")[2].split(":", 1)[0].strip(".")
+    return entry[4:] if entry.startswith("www.") else entry
+
+
+class DomainTrie:
+    """Allowlisted domains stored as a trie of reversed host labels
+
+    "example.com" becomes com -> example, so looking up a host walks one
+    node per label, from the top-level domain down, whatever the number of
+    entries. An entry also covers its subdomains, while a look-alike such
+    as "example.com.evil.net" shares no path with it. IP addresses and
+    single-label hosts are never allowed.
+    """
+
+    _END = ""  # Key marking an allowlisted domain; labels are never empty
+
+    def __init__(self, domains=()):
+        self.root = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        """Allow domain and its subdomains; returns False for an entry with no usable host"""
+        host = domain_host(domain)
+        if not host:
+            return False
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.setdefault(label, {})
+        if self._END not in node:
+            node[self._END] = True
+            self.size += 1
+        return True
+
+    def __contains__(self, host):
+        if "." not in host or _IP_HOST.fullmatch(host):
+            return False  # IP addresses and single-label hosts such as localhost are never allowlisted
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        """Approximate bytes held by the trie's nodes and labels"""
+        total, nodes = 0, [self.root]
+        while nodes:
+            node = nodes.pop()
+            total += sys.getsizeof(node) + sum(map(sys.getsizeof, node))
+            nodes.extend(child for child in node.values() if isinstance(child, dict))
+        return total
+
+
+# Warning signs that are harmless alone but worrying together in one conversation
+RISK_PATTERNS = {
+    "secrecy": r"""\b(?:(?:don'?t|do\s+not|never)\s+tell|(?:our|a|my)\s+(?:little\s+)?secret
+                  |keep\s+(?:it|this)\s+(?:a\s+)?(?:secret|between\s+us)|between\s+(?:you\s+and\s+me|us)\b
+                  |delete\s+(?:this|these|the|our)\s+(?:messages?|chats?|texts?))""",
+    "age": r"""\b(?:how\s+old\s+(?:are|r)\s+(?:you|u)|what\s+grade\s+(?:are|r)\s+(?:you|u)\b
+              |(?:you|u)\s+(?:are|r|seem)\s+(?:so\s+)?mature|asl\b)""",
+    "other_app": r"""\b(?:snap(?:chat)?|whats\s*app|telegram|kik|discord|insta(?:gram)?|wechat
+                    |(?:another|other|different|private)\s+app|text\s+me\s+(?:at|on))\b""",
+    "photos": r"""\b(?:(?:send|show)\s+(?:me\s+)?(?:a\s+)?(?:pic|picture|photo|selfie|video)s?\b
+                 |(?:turn\s+on|open)\s+(?:your|ur)\s+(?:cam|camera)\b)""",
+    "meeting": r"""\b(?:meet\s+(?:me|up)|pick\s+(?:you|u)\s+up|come\s+(?:over|to\s+my)
+                  |where\s+do\s+(?:you|u)\s+live|(?:are|r)\s+(?:you|u)\s+(?:home\s+)?alone)\b""",
+    "gifts": r"""\b(?:i(?:'ll|\s+will|\s+can)\s+(?:buy|get|give|send)\s+(?:you|u)\b
+                |gift\s*cards?|free\s+(?:robux|v-?bucks|skins?)|robux|v-?bucks)\b""",
+    "isolation": r"""\b(?:(?:your|ur)\s+(?:parents|mom|dad|friends)\s+(?:don'?t|never)\s+(?:understand|care|get)
+                    |only\s+i\s+(?:understand|get)\s+(?:you|u)|(?:you|u)\s+can\s+trust\s+me)\b""",
+}
+
+RISK_KINDS = tuple(RISK_PATTERNS)
+
+RISK_PATTERN = re.compile("|".join(f"(?P<{kind}>{pattern})" for kind, pattern in RISK_PATTERNS.items()),
+                          re.IGNORECASE | re.VERBOSE)
+
+
+def risk_signals(text):
+    """Return the warning signs in one message as a bit mask over RISK_KINDS"""
+    signals = 0
+    for match in RISK_PATTERN.finditer(text.replace("\u2019", "'")):
+        signals |= 1 << RISK_KINDS.index(match.lastgroup)
+    return signals
+
+
+class ConversationRisk:
+    """Counts warning signs over the last size messages of a conversation
+
+    The per-conversation state is a short byte string: a ring holding the
+    signs of each message in the window, a running count per kind and
+    whether the conversation is already flagged. observe() adds a message's
+    signs and subtracts those of the message leaving the window, so each
+    message costs the same however long the conversation is, and nothing
+    before the window is ever read again.
+    """
+
+    def __init__(self, size=50, threshold=3):
+        if not 0 < size < 256:
+            raise ValueError("window size must be between 1 and 255 messages")
+        self.size = size
+        self.threshold = threshold  # Distinct kinds in one window that flag the conversation
+        self.state_size = 2 + len(RISK_KINDS) + size  # Ring head, flagged, counts, ring
+
+    def observe(self, state, signals):
+        """Return (new state, kinds) after one more message with the given signals
+
+        kinds lists the warning signs in the window when this message made
+        the conversation cross the threshold, and is empty otherwise. state
+        is None (or from a different window size) for a new conversation.
+        """
+        state = bytearray(state) if state and len(state) == self.state_size else bytearray(self.state_size)
+        kinds = len(RISK_KINDS)
+        slot = 2 + kinds + state[0]
+        leaving = state[slot]
+        for bit in range(kinds):
+            state[2 + bit] += (signals >> bit & 1) - (leaving >> bit & 1)
+        state[slot] = signals
+        state[0] = (state[0] + 1) % self.size
+        present = [kind for bit, kind in enumerate(RISK_KINDS) if state[2 + bit]]
+        flagged = len(present) >= self.threshold
+        crossed = flagged and not state[1]
+        state[1] = flagged
+        return bytes(state), present if crossed else []
+
+
+SIGNATURE_SIZE = 8  # Hashes kept per message
+_TOKEN = re.compile(r"\w+")
+
+
+def signature(text, size=SIGNATURE_SIZE):
+    """Return a bottom-k MinHash of the words in text: its size smallest word hashes, packed
+
+    Case and punctuation are ignored, so "are you online??" and "Are you
+    online?!" get the same signature. Words rather than character n-grams
+    keep this to a few microseconds per message. Text with no words, such
+    as emoji or a fully masked message, is signed by a hash of the whole
+    text instead, so it only resembles exact repeats of itself.
+    """
+    text = text.casefold()
+    words = set(_TOKEN.findall(text)) or (text,)
+    return array("I", sorted(map(crc32, map(str.encode, words)))[:size]).tobytes()
+
+
+def _hashes(signature):
+    hashes = array("I")
+    hashes.frombytes(signature)
+    return hashes
+
+
+def resemblance(a, b, size=SIGNATURE_SIZE):
+    """Estimate how alike two messages' word sets are, from 0.0 to 1.0, given their signatures"""
+    return _resemblance(set(_hashes(a)), set(_hashes(b)), size)
+
+
+def _resemblance(a, b, size):
+    union = sorted(a | b)[:size]
+    return len(a.intersection(b, union)) / len(union) if union else 1.0
+
+
+def near_duplicates(signatures, threshold=0.6, bands=2, rows=2, owners=None):
+    """Group near-identical messages, returning lists of indexes into signatures
+
+    Locality-sensitive hashing: a signature is cut into bands of rows
+    hashes, and messages are only compared when a whole band matches, so a
+    word that many unrelated messages share does not put them together.
+    With owners (one hashable per signature, such as the sender and
+    receiver) only messages with equal owners are grouped. An empty
+    signature, stored before wordless text was signed, stays on its own.
+    Each bucket keeps one message per group to compare against. Groups come
+    out in order of their first member and keep their members in input
+    order.
+    """
+    groups = list(range(len(signatures)))
+
+    def find(i):
+        while groups[i] != i:
+            groups[i] = i = groups[groups[i]]
+        return i
+
+    hashes = [set(_hashes(sig)) for sig in signatures]
+    width = rows * array("I").itemsize
+    buckets = {}
+    for i, sig in enumerate(signatures):
+        for band in range(min(bands, -(-len(sig) // width))):
+            owner = owners[i] if owners is not None else None
+            representatives = buckets.setdefault((owner, band, sig[band * width:(band + 1) * width]), [])
+            grouped = False
+            for j in representatives:
+                if find(j) == find(i):
+                    grouped = True
+                elif _resemblance(hashes[i], hashes[j], SIGNATURE_SIZE) >= threshold:
+                    groups[find(i)] = find(j)
+                    grouped = True
+            if not grouped:
+                representatives.append(i)
+    clusters = {}
+    for i in range(len(signatures)):
+        clusters.setdefault(find(i), []).append(i)
+    return sorted(clusters.values())
+
+
+def parse_terms(text):
+    """Return the terms of a dictionary file: one per line, # starts a comment line"""
+    terms = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            terms.append(line)
+    return terms
+
+
+class Dictionary:
+    """A term list on disk and the compiled snapshots that serve it
+
+    Snapshots are named after a digest of the list and of the normalization
+    rules, so an unchanged list is mapped straight from disk at startup and
+    an edited one gets a new file; a snapshot that may still be mapped is
+    never written over.
+    """
+
+    def __init__(self, source, snapshot_dir=None, normalizer=None):
+        self.source = source
+        self.snapshot_dir = snapshot_dir or os.path.join(os.path.dirname(source) or ".", "compiled")
+        self.normalizer = normalizer
+
+    def stamp(self):
+        """Return (mtime, size) of the source, which changes whenever it is edited"""
+        stat = os.stat(self.source)
+        return stat.st_mtime_ns, stat.st_size
+
+    def digest(self, raw):
+        """Identify a build: the same list and normalization rules give the same digest"""
+        digest = hashlib.sha256()
+        digest.update(f"{SNAPSHOT_FORMAT}:{unicodedata.unidata_version}:".encode())
+        if self.normalizer:
+            digest.update(repr(sorted(LEET.items())).encode())
+        digest.update(raw)
+        return digest.hexdigest()
+
+    def snapshot_path(self, raw):
+        stem = os.path.splitext(os.path.basename(self.source))[0]
+        return os.path.join(self.snapshot_dir, f"{stem}-{self.digest(raw)[:16]}.snapshot")
+
+    def load(self):
+        """Return the automaton for the current source, compiling it only if no snapshot exists
+
+        The automaton's digest attribute identifies the build.
+        """
+        with open(self.source, "rb") as f:
+            raw = f.read()
+        automaton = self._load(raw)
+        automaton.digest = self.digest(raw)
+        return automaton
+
+    def _load(self, raw):
+        path = self.snapshot_path(raw)
+        try:
+            return Automaton.load(path)
+        except (OSError, ValueError):
+            pass
+        terms = parse_terms(raw.decode("utf-8"))
+        if self.normalizer:
+            terms = [self.normalizer.normalize(term)[0] for term in terms]
+        automaton = Automaton(terms)
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            automaton.save(path)
+        except OSError:
+            return automaton  # Read-only install: serve the freshly built tables
+        self.discard_stale(path)
+        return Automaton.load(path)
+
+    def discard_stale(self, keep):
+        """Delete older snapshots of this dictionary, skipping any that are still in use"""
+        prefix = os.path.splitext(os.path.basename(self.source))[0] + "-"
+        for name in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, name)
+            if name.startswith(prefix) and name.endswith(".snapshot") and path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Windows refuses while another process has it mapped
+
+
+class FamilyOverlays:
+    """Per-family word lists layered over the shared dictionary, loaded on first use
+
+    terms_for(family) returns a family's own terms, which get a small
+    automaton of their own that is scanned in the same pass as the shared
+    one; the shared automaton is never copied, so a family costs only its
+    overlay (see nbytes()). Families unused for idle seconds are dropped
+    and loaded again the next time they are needed.
+    """
+
+    def __init__(self, terms_for, normalizer=None, idle=600.0):
+        self.terms_for = terms_for
+        self.normalizer = normalizer
+        self.idle = idle
+        self.builds = count(1)
+        self._overlays = OrderedDict()  # family -> [automaton or None, last used], least recent first
+        self._lock = threading.Lock()
+
+    def get(self, family):
+        """Return the family's overlay automaton, or None if it has no terms of its own"""
+        now = time.monotonic()
+        with self._lock:
+            while self._overlays:
+                oldest = next(iter(self._overlays.values()))
+                if now - oldest[1] <= self.idle:
+                    break
+                self._overlays.popitem(last=False)
+            entry = self._overlays.get(family)
+            if entry is not None:
+                entry[1] = now
+                self._overlays.move_to_end(family)
+                return entry[0]
+        overlay = self._build(self.terms_for(family))
+        with self._lock:
+            self._overlays[family] = [overlay, now]
+        return overlay
+
+    def _build(self, terms):
+        if self.normalizer:
+            terms = [self.normalizer.normalize(term)[0] for term in terms]
+        overlay = Automaton(terms) if terms else None
+        if overlay is not None:
+            overlay.build = next(self.builds)
+        return overlay
+
+    def invalidate(self, family=None):
+        """Drop one family's overlay after its terms change, or every overlay"""
+        with self._lock:
+            if family is None:
+                self._overlays.clear()
+            else:
+                self._overlays.pop(family, None)
+
+    def nbytes(self):
+        """Return {family: approximate bytes} for the overlays currently loaded"""
+        with self._lock:
+            loaded = [(family, entry[0]) for family, entry in self._overlays.items()]
+        return {family: (overlay.nbytes + sys.getsizeof(overlay.classes)
+                         + sum(map(sys.getsizeof, overlay.terms)) if overlay else 0)
+                for family, overlay in loaded}
+
+
+class FamilyAllowlists(FamilyOverlays):
+    """Per-family link allowlists, each a DomainTrie, loaded and dropped like FamilyOverlays"""
+
+    def __init__(self, domains_for, idle=600.0):
+        super().__init__(domains_for, idle=idle)
+
+    def _build(self, domains):
+        return DomainTrie(domains) if domains else None
+
+    def nbytes(self):
+        with self._lock:
+            loaded = [(family, entry[0]) for family, entry in self._overlays.items()]
+        return {family: trie.nbytes if trie else 0 for family, trie in loaded}
+
+
+class VerdictCache:
+    """Bounded LRU cache of scan results, keyed by a hash of the normalized text
+
+    Entries hold the spans found in the normalized text and the dictionary
+    build they were found with; an entry from any other build is a miss, so
+    a reload can never serve a stale verdict even to a scan already in
+    flight. The masked text is not stored: messages that normalize alike
+    ("ok", "OK", "0k") differ in the original, and masking is cheap.
+    """
+
+    def __init__(self, maxsize=10_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(folded):
+        return hashlib.blake2b(folded.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get(self, key, build):
+        """Return the cached spans for key, or None"""
+        with self._lock:
+            entry = self._verdicts.get(key)
+            if entry is not None and entry[0] == build:
+                self._verdicts.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, build, spans):
+        with self._lock:
+            self._verdicts[key] = (build, spans)
+            self._verdicts.move_to_end(key)
+            if len(self._verdicts) > self.maxsize:
+                self._verdicts.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every entry"""
+        with self._lock:
+            self._verdicts.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class ContentFilter:
+    """Finds and masks blocked terms in a single pass over each message
+
+    Messages are normalized first, so "B4D", full-width letters, zero-width
+    joiners and accents do not hide a term. With fuzzy, misspelled words
+    ("stoopid") are caught as well.
+    """
+
+    def __init__(self, terms=DEFAULT_TERMS, normalize=True, dictionary=None, versions=None, fuzzy=False,
+                 prefilter=None, cache_size=0, family_terms=None, allowed_domains=None, family_domains=None):
+        self.terms = tuple(terms)
+        self.normalizer = Normalizer() if normalize else None
+        self.dictionary = None
+        self.versions = versions
+        self.fuzzy = fuzzy
+        self.prefilter = prefilter  # Bloom false-positive rate, or None to always run the automaton
+        self.cache = VerdictCache(cache_size) if cache_size else None
+        self.overlays = FamilyOverlays(family_terms, self.normalizer) if family_terms else None
+        # Links are only checked when there is an allowlist: every unlisted host is held for review
+        self.allowed = DomainTrie(allowed_domains or ())
+        self.allowlists = FamilyAllowlists(family_domains) if family_domains else None
+        self.check_links = allowed_domains is not None or family_domains is not None
+        self.builds = count(1)
+        self.watcher = None
+        self.stopping = threading.Event()
+        self.fuzzy_builder = None
+        if dictionary is not None:
+            self.dictionary = Dictionary(dictionary, normalizer=self.normalizer)
+            self.stamp = self.dictionary.stamp()
+            self.automaton = self._load(background=True)
+            return
+        if self.normalizer:
+            terms = [self.normalizer.normalize(term)[0] for term in terms]
+        self.automaton = self._prepare(Automaton(terms), 0, background=True)
+
+    def _load(self, background=False):
+        automaton = self.dictionary.load()
+        return self._prepare(automaton, self.versions(automaton.digest) if self.versions else 0, background)
+
+    def _prepare(self, automaton, version, background=False):
+        # Everything that belongs to one dictionary hangs off its automaton, so it is swapped as a unit.
+        # At startup the fuzzy index is built in the background, keeping startup at snapshot speed;
+        # a reload builds it on the watcher thread before the swap.
+        automaton.version = version
+        automaton.build = next(self.builds)
+        automaton.fuzzy = None
+        automaton.prefilter = Prefilter(automaton.terms, self.prefilter) if self.prefilter else None
+        if self.fuzzy and background:
+            self.fuzzy_builder = threading.Thread(target=self._add_fuzzy, args=(automaton,), daemon=True)
+            self.fuzzy_builder.start()
+        elif self.fuzzy:
+            automaton.fuzzy = FuzzyMatcher(automaton.terms)
+        return automaton
+
+    def _add_fuzzy(self, automaton):
+        automaton.fuzzy = FuzzyMatcher(automaton.terms)
+        # A new build number retires cached verdicts that were found without fuzzy matching
+        automaton.build = next(self.builds)
+
+    def wait_ready(self, timeout=None):
+        """Block until the startup fuzzy index is built; returns False on timeout
+
+        Until then scan() finds exact (normalized) matches only, so batch
+        re-scans should wait for it.
+        """
+        if self.fuzzy_builder is not None:
+            self.fuzzy_builder.join(timeout)
+            return not self.fuzzy_builder.is_alive()
+        return True
+
+    @property
+    def version(self):
+        """Version number of the dictionary in use: 0 unless a versions callback numbers builds
+
+        Read it before filtering: a reload in between only makes the
+        recorded version older than the one used, never newer. While the
+        startup fuzzy index is still being built this is 0, so messages
+        checked for exact matches only are re-scanned once it is ready.
+        """
+        automaton = self.automaton
+        return 0 if self.fuzzy and automaton.fuzzy is None else automaton.version
+
+    def __reduce__(self):
+        # Pickled for worker processes: they rebuild the filter, mapping a dictionary's snapshot.
+        # Family word lists and link allowlists stay behind: batch work only uses the shared dictionary.
+        source = self.dictionary.source if self.dictionary else None
+        return type(self), (self.terms, self.normalizer is not None, source, None, self.fuzzy, self.prefilter,
+                            self.cache.maxsize if self.cache else 0)
+
+    def watch(self, interval=2.0):
+        """Reload the dictionary file in the background whenever it changes
+
+        The new automaton is built (or mapped) completely before it replaces
+        the old one in a single assignment, and scan() reads the reference
+        once, so a message is always checked against one whole dictionary.
+        """
+        if self.dictionary is None or self.watcher is not None:
+            return
+        self.watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+        self.watcher.start()
+
+    def _watch(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                stamp = self.dictionary.stamp()
+                if stamp != self.stamp:
+                    self.automaton = self._load()
+                    self.stamp = stamp
+                    if self.cache is not None:
+                        self.cache.invalidate()
+            except (OSError, ValueError):
+                pass  # Mid-save or missing: keep the current dictionary and try again
+            except Exception:
+                # Such as the versions callback finding the database locked: the stamp is
+                # unchanged, so the reload is tried again next interval
+                log.exception("Reloading %s failed; keeping the current dictionary", self.dictionary.source)
+
+    def close(self):
+        """Stop the dictionary watcher"""
+        self.stopping.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+
+    def scan(self, text, families=()):
+        """Return the (start, end, term) spans of blocked terms in text
+
+        Spans index the original text even when normalization changed its
+        length. families adds the word lists of those guardians.
+        """
+        automaton = self.automaton
+        build, fuzzy = automaton.build, automaton.fuzzy  # In this order: the fuzzy index is set before its build
+        overlays = []
+        if self.overlays is not None:
+            overlays = [overlay for overlay in map(self.overlays.get, families) if overlay is not None]
+        folded, offsets = self.normalizer.normalize(text) if self.normalizer else (text, None)
+        if self.cache is not None:
+            key = (self.cache.key(folded), tuple(overlay.build for overlay in overlays))
+            spans = self.cache.get(key, build)
+            if spans is not None:
+                return to_original(list(spans), offsets)
+        if automaton.prefilter is None or automaton.prefilter.may_match(folded):
+            overlays.insert(0, automaton)
+        spans = find_layered(folded, overlays) if overlays else []
+        if fuzzy is not None:
+            exact = set(spans)
+            spans += [span for span in fuzzy.find(folded) if span not in exact]
+        if self.cache is not None:
+            self.cache.put(key, build, tuple(spans))
+        return to_original(spans, offsets)
+
+    def held_links(self, text, families=()):
+        """Return (start, end, host) for links in text that are not allowlisted
+
+        A host passes if the global allowlist has it, or if every family in
+        families allows it: one guardian's list does not open links for the
+        other family's child.
+        """
+        if not self.check_links:
+            return []
+        held = []
+        for start, end, host in find_urls(text):
+            if host in self.allowed:
+                continue
+            tries = list(map(self.allowlists.get, families)) if self.allowlists is not None else []
+            if not tries or not all(trie is not None and host in trie for trie in tries):
+                held.append((start, end, host))
+        return held
+
+    def inspect(self, text, families=()):
+        """Return sorted (start, end, kind) spans for review: "blocked" terms, held links and each kind of PII"""
+        spans = [(start, end, "blocked") for start, end, _ in self.scan(text, families)]
+        spans += [(start, end, "link") for start, end, _ in self.held_links(text, families)]
+        return sorted(spans + find_pii(text))
+
+    def content_key(self, sender_id, receiver_id, text):
+        """Return a 16-byte digest of who sent text to whom and its normalized form
+
+        Messages that normalize alike ("ok!!", "OK!!") between the same two
+        users share a key, so a guardian's approval of one can be reused.
+        """
+        folded = self.normalizer.normalize(text)[0] if self.normalizer else text
+        return VerdictCache.key(f"{sender_id}:{receiver_id}:{folded}")
+
+    def filter(self, text, families=()):
+        """Return (masked text, spans) for text"""
+        spans = self.scan(text, families)
+        return mask(text, spans), spans
+
+
+class BatchStats:
+    """Throughput and per-chunk latency of a filter_batch() run, updated as it goes"""
+
+    def __init__(self):
+        self.messages = 0
+        self.chunk_seconds = []  # Filtering time of each chunk, in input order
+        self.elapsed = 0.0
+
+    def record(self, messages, seconds, elapsed):
+        self.messages += messages
+        self.chunk_seconds.append(seconds)
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        """Messages per second of wall-clock time"""
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def latency(self, fraction=0.5):
+        """Chunk latency in seconds at the given fraction, e.g. 0.95 for p95"""
+        if not self.chunk_seconds:
+            return 0.0
+        ordered = sorted(self.chunk_seconds)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+_worker_filter = None
+
+
+def _start_worker(content_filter):
+    global _worker_filter
+    _worker_filter = content_filter
+    content_filter.wait_ready()
+
+
+def _filter_chunk(messages, content_filter=None):
+    start = time.perf_counter()
+    results = [(content_filter or _worker_filter).filter(message) for message in messages]
+    return results, time.perf_counter() - start
+
+
+def filter_batch(messages, content_filter=None, chunk_size=1000, workers=0, stats=None):
+    """Filter any number of messages, yielding a list of (masked, spans) per chunk
+
+    messages can be any iterable, such as a database cursor; it is read one
+    chunk at a time so memory stays bounded. With workers the chunks are
+    spread over that many processes, with at most two chunks per worker in
+    flight, and results still come back in input order. Pass a BatchStats
+    to watch throughput and chunk latency.
+    """
+    content_filter = content_filter or ContentFilter()
+    content_filter.wait_ready()
+    if stats is None:
+        stats = BatchStats()
+    messages = iter(messages)
+    chunks = iter(lambda: list(islice(messages, chunk_size)), [])
+    start = time.perf_counter()
+    if not workers:
+        for chunk in chunks:
+            results, seconds = _filter_chunk(chunk, content_filter)
+            stats.record(len(chunk), seconds, time.perf_counter() - start)
+            yield results
+        return
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(content_filter,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((len(chunk), pool.submit(_filter_chunk, chunk)))
+            if len(pending) < 2 * workers:
+                continue
+            count, future = pending.popleft()
+            results, seconds = future.result()
+            stats.record(count, seconds, time.perf_counter() - start)
+            yield results
+        while pending:
+            count, future = pending.popleft()
+            results, seconds = future.result()
+            stats.record(count, seconds, time.perf_counter() - start)
+            yield results
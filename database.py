@@ -0,0 +1,1154 @@
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def _create_base_tables(c):
+    """Version 1: users, contacts and messages"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            is_parent INTEGER NOT NULL DEFAULT 0,
+            parent_id INTEGER,
+            FOREIGN KEY(parent_id) REFERENCES users(id)
+        )''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            contact_id INTEGER NOT NULL,
+            approved INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(contact_id) REFERENCES users(id),
+            UNIQUE(user_id, contact_id)
+        )''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            approved INTEGER NOT NULL DEFAULT 0,
+            is_visible INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(sender_id) REFERENCES users(id),
+            FOREIGN KEY(receiver_id) REFERENCES users(id)
+        )''')
+
+
+def _create_lookup_indexes(c):
+    """Version 2: secondary indexes for every production query
+
+    Message indexes are partial so they only hold the rows each screen can
+    actually show: visible history for conversations, unapproved rows for the
+    review queue. Message bodies are left out to keep the indexes small.
+    """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_parent ON users(parent_id)")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_contacts_pending
+                 ON contacts(user_id) WHERE approved=0""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_pair
+                 ON messages(sender_id, receiver_id, timestamp) WHERE is_visible=1""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_incoming
+                 ON messages(receiver_id, timestamp) WHERE is_visible=1""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_sender
+                 ON messages(sender_id) WHERE approved=0""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_receiver
+                 ON messages(receiver_id) WHERE approved=0""")
+
+
+def _create_outgoing_index(c):
+    """Version 3: time-ordered index on a sender's visible messages"""
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_outgoing
+                 ON messages(sender_id, timestamp) WHERE is_visible=1""")
+
+
+def _add_message_clock(c):
+    """Version 4: integer send time and per-conversation sequence numbers
+
+    Existing rows keep NULL in both columns until backfill_message_clock()
+    reaches them, so the migration itself never rewrites the messages table.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN sent_at INTEGER")  # Epoch microseconds
+    c.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+    # New messages count last_seq up from 1; the backfill counts first_seq
+    # down from 0, so old history always sorts before anything sent since.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_low INTEGER NOT NULL,
+            user_high INTEGER NOT NULL,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            first_seq INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY(user_low, user_high)
+        ) WITHOUT ROWID''')
+    c.execute("DROP INDEX IF EXISTS idx_messages_visible_pair")
+    c.execute("DROP INDEX IF EXISTS idx_messages_visible_incoming")
+    c.execute("DROP INDEX IF EXISTS idx_messages_visible_outgoing")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_seq
+                 ON messages(sender_id, receiver_id, seq) WHERE is_visible=1""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_sent
+                 ON messages(sender_id, sent_at) WHERE is_visible=1""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_visible_received
+                 ON messages(receiver_id, sent_at) WHERE is_visible=1""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_unsequenced
+                 ON messages(id) WHERE seq IS NULL""")
+
+
+def _add_guardian_queue(c):
+    """Version 5: per-guardian pending counters kept current by triggers
+
+    A message counts once for each distinct guardian of its sender and
+    receiver, a contact request once for the requesting child's guardian,
+    matching the review queues. Approvals and rejections both leave the
+    queue, so rejected rows are stored as REJECTED rather than 0.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS guardian_queue (
+            parent_id INTEGER PRIMARY KEY,
+            pending_messages INTEGER NOT NULL DEFAULT 0,
+            pending_contacts INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(parent_id) REFERENCES users(id)
+        )''')
+
+    # Which users' guardians a row counts towards, per table
+    for table, column, owners in (("messages", "pending_messages", "id IN ({row}.sender_id, {row}.receiver_id)"),
+                                  ("contacts", "pending_contacts", "id={row}.user_id")):
+        enqueue = f"""INSERT INTO guardian_queue (parent_id, {column})
+                      SELECT DISTINCT parent_id, 1 FROM users
+                      WHERE {owners.format(row="NEW")} AND parent_id IS NOT NULL
+                      ON CONFLICT(parent_id) DO UPDATE SET {column} = {column} + 1;"""
+        dequeue = f"""UPDATE guardian_queue SET {column} = {column} - 1
+                      WHERE parent_id IN (SELECT parent_id FROM users WHERE {owners.format(row="OLD")});"""
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_queue_insert
+                      AFTER INSERT ON {table} WHEN NEW.approved=0
+                      BEGIN {enqueue} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_queue_delete
+                      AFTER DELETE ON {table} WHEN OLD.approved=0
+                      BEGIN {dequeue} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_queue_leave
+                      AFTER UPDATE OF approved ON {table} WHEN OLD.approved=0 AND NEW.approved<>0
+                      BEGIN {dequeue} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_queue_return
+                      AFTER UPDATE OF approved ON {table} WHEN OLD.approved<>0 AND NEW.approved=0
+                      BEGIN {enqueue} END""")
+
+    c.execute("""INSERT INTO guardian_queue (parent_id, pending_messages)
+                 SELECT parent_id, COUNT(*) FROM (
+                     SELECT DISTINCT m.id, u.parent_id FROM messages m
+                     JOIN users u ON u.id IN (m.sender_id, m.receiver_id)
+                     WHERE m.approved=0 AND u.parent_id IS NOT NULL)
+                 GROUP BY parent_id
+                 ON CONFLICT(parent_id) DO UPDATE SET pending_messages = excluded.pending_messages""")
+    c.execute("""INSERT INTO guardian_queue (parent_id, pending_contacts)
+                 SELECT u.parent_id, COUNT(*) FROM contacts c JOIN users u ON c.user_id = u.id
+                 WHERE c.approved=0 AND u.parent_id IS NOT NULL
+                 GROUP BY u.parent_id
+                 ON CONFLICT(parent_id) DO UPDATE SET pending_contacts = excluded.pending_contacts""")
+
+
+def _add_message_guardians(c):
+    """Version 6: record each message's sender and receiver guardians
+
+    The review queue then becomes an index range scan on the guardian
+    columns, and the queue counters no longer look up users on insert.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN sender_guardian_id INTEGER REFERENCES users(id)")
+    c.execute("ALTER TABLE messages ADD COLUMN receiver_guardian_id INTEGER REFERENCES users(id)")
+    c.execute("""UPDATE messages SET
+                 sender_guardian_id = (SELECT parent_id FROM users WHERE id = messages.sender_id),
+                 receiver_guardian_id = (SELECT parent_id FROM users WHERE id = messages.receiver_id)""")
+
+    c.execute("DROP INDEX IF EXISTS idx_messages_pending_sender")
+    c.execute("DROP INDEX IF EXISTS idx_messages_pending_receiver")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_sender_guardian
+                 ON messages(sender_guardian_id) WHERE approved=0""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_receiver_guardian
+                 ON messages(receiver_guardian_id) WHERE approved=0""")
+
+    enqueue = """INSERT INTO guardian_queue (parent_id, pending_messages)
+                 SELECT guardian, 1 FROM (SELECT NEW.sender_guardian_id AS guardian
+                                          UNION SELECT NEW.receiver_guardian_id)
+                 WHERE guardian IS NOT NULL
+                 ON CONFLICT(parent_id) DO UPDATE SET pending_messages = pending_messages + 1;"""
+    dequeue = """UPDATE guardian_queue SET pending_messages = pending_messages - 1
+                 WHERE parent_id IN (OLD.sender_guardian_id, OLD.receiver_guardian_id);"""
+    for trigger in ("insert", "delete", "leave", "return"):
+        c.execute(f"DROP TRIGGER IF EXISTS messages_queue_{trigger}")
+    c.execute(f"""CREATE TRIGGER messages_queue_insert
+                  AFTER INSERT ON messages WHEN NEW.approved=0
+                  BEGIN {enqueue} END""")
+    c.execute(f"""CREATE TRIGGER messages_queue_delete
+                  AFTER DELETE ON messages WHEN OLD.approved=0
+                  BEGIN {dequeue} END""")
+    c.execute(f"""CREATE TRIGGER messages_queue_leave
+                  AFTER UPDATE OF approved ON messages WHEN OLD.approved=0 AND NEW.approved<>0
+                  BEGIN {dequeue} END""")
+    c.execute(f"""CREATE TRIGGER messages_queue_return
+                  AFTER UPDATE OF approved ON messages WHEN OLD.approved<>0 AND NEW.approved=0
+                  BEGIN {enqueue} END""")
+
+
+def _add_filter_versions(c):
+    """Version 7: record which content-filter dictionary scanned each message
+
+    Dictionary builds are numbered in filter_versions. Existing messages
+    start at version 0, behind every build, so the first re-scan covers the
+    whole history; the index keeps later re-scans to the stale rows.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS filter_versions (
+                     version INTEGER PRIMARY KEY,
+                     digest TEXT NOT NULL,
+                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                 )""")
+    c.execute("ALTER TABLE messages ADD COLUMN filter_version INTEGER NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_filter_version ON messages(filter_version)")
+
+
+def _add_family_terms(c):
+    """Version 8: blocked terms a guardian adds for their own family"""
+    c.execute("""CREATE TABLE IF NOT EXISTS family_terms (
+                     parent_id INTEGER NOT NULL REFERENCES users(id),
+                     term TEXT NOT NULL,
+                     PRIMARY KEY (parent_id, term)
+                 ) WITHOUT ROWID""")
+
+
+def _add_message_risk(c):
+    """Version 9: a risk score per message, so the review queue can put the worst first
+
+    Scores are filled in after insert by batch scoring; NULL means not
+    scored yet. The pending indexes gain the score so each guardian's queue
+    comes out of the index already ordered.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN risk REAL")
+    c.execute("DROP INDEX IF EXISTS idx_messages_pending_sender_guardian")
+    c.execute("DROP INDEX IF EXISTS idx_messages_pending_receiver_guardian")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_sender_risk
+                 ON messages(sender_guardian_id, risk) WHERE approved=0""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_messages_pending_receiver_risk
+                 ON messages(receiver_guardian_id, risk) WHERE approved=0""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_unscored ON messages(id) WHERE risk IS NULL")
+
+
+def _add_family_domains(c):
+    """Version 10: sites a guardian allows links to in their family's messages"""
+    c.execute("""CREATE TABLE IF NOT EXISTS family_domains (
+                     parent_id INTEGER NOT NULL REFERENCES users(id),
+                     domain TEXT NOT NULL,
+                     PRIMARY KEY (parent_id, domain)
+                 ) WITHOUT ROWID""")
+
+
+def _add_conversation_flags(c):
+    """Version 11: warning-sign window per conversation, and the flags it raises for guardians
+
+    risk_window is the small state a conversation's risk detector keeps
+    between messages; NULL starts an empty window.
+    """
+    c.execute("ALTER TABLE conversations ADD COLUMN risk_window BLOB")
+    c.execute("""CREATE TABLE IF NOT EXISTS conversation_flags (
+                     id INTEGER PRIMARY KEY,
+                     parent_id INTEGER NOT NULL REFERENCES users(id),
+                     user_low INTEGER NOT NULL,
+                     user_high INTEGER NOT NULL,
+                     kinds TEXT NOT NULL,
+                     flagged_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                     dismissed INTEGER NOT NULL DEFAULT 0
+                 )""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_conversation_flags_open
+                 ON conversation_flags(parent_id) WHERE dismissed=0""")
+
+
+def _add_message_signature(c):
+    """Version 12: a near-duplicate signature per message, so the review queue can group them
+
+    Older messages keep NULL and are signed when they are reviewed.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN signature BLOB")
+
+
+def _add_approved_content(c):
+    """Version 13: remember approved messages so an identical one can skip the queue
+
+    Each message stores a digest of its sender, receiver and normalized
+    text; approving a message records its digest and time in
+    approved_content, and a later message with the same digest within the
+    reuse period is shown at once. Older messages have no digest and are
+    never reused.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN content_key BLOB")
+    c.execute("""CREATE TABLE IF NOT EXISTS approved_content (
+                     content_key BLOB PRIMARY KEY,
+                     approved_at INTEGER NOT NULL
+                 ) WITHOUT ROWID""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_approved_content_time ON approved_content(approved_at)")
+
+
+def _add_message_review_time(c):
+    """Version 14: when a guardian approved or rejected each message
+
+    Only these decisions train the risk model; messages approved on sending
+    (a guardian's own, or a reused approval) stay NULL. Older messages keep
+    NULL too, since there is no telling who approved them.
+    """
+    c.execute("ALTER TABLE messages ADD COLUMN reviewed_at INTEGER")
+
+
+# Ordered (version, step) pairs. Never edit a released step; append a new one.
+MIGRATIONS = [
+    (1, _create_base_tables),
+    (2, _create_lookup_indexes),
+    (3, _create_outgoing_index),
+    (4, _add_message_clock),
+    (5, _add_guardian_queue),
+    (6, _add_message_guardians),
+    (7, _add_filter_versions),
+    (8, _add_family_terms),
+    (9, _add_message_risk),
+    (10, _add_family_domains),
+    (11, _add_conversation_flags),
+    (12, _add_message_signature),
+    (13, _add_approved_content),
+    (14, _add_message_review_time),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    """Return the schema version stored in the database file"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every missing migration step in a single transaction
+
+    Returns the schema version after migrating. A database that is already
+    current costs one PRAGMA read and no writes.
+    """
+    current = schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        return current
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-read under the write lock in case another process migrated first
+        current = schema_version(conn)
+        c = conn.cursor()
+        for version, step in MIGRATIONS:
+            if version > current:
+                step(c)
+                current = version
+        c.execute(f"PRAGMA user_version = {int(current)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return current
+
+
+class Database:
+    """WAL-mode data access: one writer connection plus a pool of readers
+
+    Every call checks out its own cursor, so the object can be shared between
+    threads. Readers never wait for a commit in progress; writers are
+    serialised behind a lock and run in BEGIN IMMEDIATE transactions.
+    """
+
+    def __init__(self, path, readers=4, timeout=5.0, durability="normal"):
+        self.path = path
+        self.timeout = timeout
+        self._write_lock = threading.RLock()
+        self._writer = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self.set_durability(durability)
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(readers)
+        self._last_clock = 0
+
+    def set_durability(self, mode):
+        """Choose how hard each commit is pushed to disk, see DURABILITY"""
+        with self._write_lock:
+            self._writer.execute(f"PRAGMA synchronous={DURABILITY[mode]}")
+
+    def migrate(self):
+        """Bring the schema up to date on the writer connection"""
+        with self._write_lock:
+            return migrate(self._writer)
+
+    def _open_reader(self):
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True,
+                               timeout=self.timeout, check_same_thread=False)
+
+    @contextmanager
+    def read(self):
+        """Check out a pooled read-only connection and yield a fresh cursor"""
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._open_reader()
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    @contextmanager
+    def write(self):
+        """Yield a writer cursor inside a transaction, committing on success"""
+        with self._write_lock:
+            if self._writer.in_transaction:
+                # Nested write blocks join the enclosing transaction
+                yield self._writer.cursor()
+                return
+            self._writer.execute("BEGIN IMMEDIATE")
+            cursor = self._writer.cursor()
+            try:
+                yield cursor
+            except BaseException:
+                self._writer.rollback()
+                raise
+            else:
+                self._writer.commit()
+            finally:
+                cursor.close()
+
+    def clock(self):
+        """Return a strictly increasing epoch-microsecond timestamp
+
+        Call it inside write() so the values match commit order.
+        """
+        with self._write_lock:
+            self._last_clock = max(time.time_ns() // 1000, self._last_clock + 1)
+            return self._last_clock
+
+    def fetchone(self, sql, params=()):
+        with self.read() as c:
+            return c.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.read() as c:
+            return c.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        """Run one write statement in its own transaction and return lastrowid"""
+        with self.write() as c:
+            c.execute(sql, params)
+            return c.lastrowid
+
+    def run(self, fn, *args):
+        """Call fn(cursor, *args) in its own write transaction and return its result"""
+        with self.write() as c:
+            return fn(c, *args)
+
+    def close(self):
+        with self._write_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._writer.close()
+
+
+class WriteQueue:
+    """Write-behind queue that commits many small writes in one transaction
+
+    Writes wait at most max_delay seconds, or until max_batch of them are
+    queued, and then share a single commit. The wait also ends once as many
+    writes as the previous batch held have arrived, so a lone writer is not
+    held up for the whole budget. Each write runs in its own
+    savepoint, so one failing write does not abort the rest of its batch.
+    Callers only get their result once the batch has committed.
+
+    The queue offers the same write and read methods as Database, so either
+    can be passed wherever writes are issued.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db, max_delay=0.005, max_batch=256, durability=None):
+        self.db = db
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        if durability is not None:
+            db.set_durability(durability)
+        self._queue = queue.Queue()
+        self._last_batch = max_batch
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="write-queue", daemon=True)
+        self._worker.start()
+
+    def submit(self, fn, *args):
+        """Queue fn(cursor, *args) and return a Future for its result"""
+        if self._closed:
+            raise RuntimeError("write queue is closed")
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def execute(self, sql, params=()):
+        return self.run(_execute_returning_rowid, sql, params)
+
+    def clock(self):
+        return self.db.clock()
+
+    def fetchone(self, sql, params=()):
+        return self.db.fetchone(sql, params)
+
+    def fetchall(self, sql, params=()):
+        return self.db.fetchall(sql, params)
+
+    def flush(self):
+        """Block until everything queued so far has been committed"""
+        self.run(lambda c: None)
+
+    def close(self):
+        """Flush queued writes and stop the worker; call on shutdown"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            # Expect about as many writers as last time; once they have all
+            # arrived there is no point waiting out the rest of the budget.
+            target = min(self.max_batch, max(self._last_batch, 1))
+            while len(batch) < self.max_batch:
+                # Past the target, only take writes that are already queued
+                timeout = max(deadline - time.monotonic(), 0) if len(batch) < target else 0
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._last_batch = len(batch)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with self.db.write() as c:
+                for future, fn, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    c.execute("SAVEPOINT queued_write")
+                    try:
+                        outcomes.append((future, fn(c, *args), None))
+                    except Exception as e:
+                        c.execute("ROLLBACK TO queued_write")
+                        outcomes.append((future, None, e))
+                    c.execute("RELEASE queued_write")
+        except Exception as e:
+            # The transaction itself failed, so nothing in the batch was stored
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(outcomes)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _execute_returning_rowid(c, sql, params):
+    c.execute(sql, params)
+    return c.lastrowid
+
+
+class UserDirectory:
+    """Bounded LRU cache of username -> user id
+
+    Misses are not cached: another instance of the app may create the user
+    at any time, and a cached None would hide it until restart.
+    """
+
+    def __init__(self, db, maxsize=1024):
+        self.db = db
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def remember(self, username, user_id):
+        with self._lock:
+            self._ids[username] = user_id
+            self._ids.move_to_end(username)
+            if len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def lookup(self, username):
+        """Return the id for username, or None if no such user exists"""
+        with self._lock:
+            if username in self._ids:
+                self._ids.move_to_end(username)
+                return self._ids[username]
+        row = self.db.fetchone(USER_ID_BY_USERNAME_SQL, (username,))
+        if row is None:
+            return None
+        self.remember(username, row[0])
+        return row[0]
+
+    def invalidate(self, username=None):
+        """Drop one cached username, or the whole cache"""
+        with self._lock:
+            if username is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(username, None)
+
+
+# PRAGMA synchronous level for each durability mode. In WAL mode "normal"
+# survives an application crash but may lose the last commits on power loss.
+DURABILITY = {
+    "full": "FULL",
+    "normal": "NORMAL",
+    "off": "OFF",
+}
+
+# Values of messages.approved and contacts.approved
+PENDING = 0
+APPROVED = 1
+REJECTED = -1
+
+
+# Production queries. Each one is listed in PRODUCTION_QUERIES so that
+# check_query_plans() can catch a query that stops using its index.
+# OR conditions are written as UNION ALL branches because SQLite cannot
+# combine partial indexes through its OR optimisation.
+
+LOGIN_SQL = "SELECT * FROM users WHERE username=? AND password=?"
+
+PARENT_BY_USERNAME_SQL = "SELECT id FROM users WHERE username=? AND is_parent=1"
+
+USER_ID_BY_USERNAME_SQL = "SELECT id FROM users WHERE username=?"
+
+CHILDREN_SQL = "SELECT id, username FROM users WHERE parent_id=?"
+
+# With each contact's family: a guardian's own id, or a child's guardian's
+APPROVED_CONTACTS_SQL = """SELECT u.id, u.username, CASE WHEN u.is_parent THEN u.id ELSE u.parent_id END
+                           FROM contacts c
+                           JOIN users u ON c.contact_id = u.id
+                           WHERE c.user_id=? AND c.approved=1"""
+
+CONTACT_EXISTS_SQL = "SELECT 1 FROM contacts WHERE user_id=? AND contact_id=?"
+
+PENDING_CONTACTS_SQL = """SELECT c.id, u1.username, u2.username
+                          FROM contacts c
+                          JOIN users u1 ON c.user_id = u1.id
+                          JOIN users u2 ON c.contact_id = u2.id
+                          WHERE u1.parent_id=? AND c.approved=0"""
+
+PENDING_COUNTS_SQL = "SELECT pending_messages, pending_contacts FROM guardian_queue WHERE parent_id=?"
+
+UPDATE_CONTACT_SQL = "UPDATE contacts SET approved=? WHERE id=?"
+
+INSERT_CONTACT_SQL = "INSERT INTO contacts (user_id, contact_id, approved) VALUES (?, ?, 0)"
+
+INSERT_USER_SQL = "INSERT INTO users (username, password, is_parent, parent_id) VALUES (?, ?, ?, ?)"
+
+# Newest-first keyset pages: rows strictly older than the cursor, so a page
+# costs the same however far back the user has scrolled. A conversation is
+# ordered by its sequence number; a child's combined history by (sent_at, id).
+CONVERSATION_PAGE_SQL = """SELECT m.id, u.username, m.message, m.timestamp, m.seq
+                           FROM messages m JOIN users u ON m.sender_id = u.id
+                           WHERE m.sender_id=:user AND m.receiver_id=:contact AND m.is_visible=1
+                           AND m.seq < :seq
+                           UNION ALL
+                           SELECT m.id, u.username, m.message, m.timestamp, m.seq
+                           FROM messages m JOIN users u ON m.sender_id = u.id
+                           WHERE m.sender_id=:contact AND m.receiver_id=:user AND m.is_visible=1
+                           AND m.seq < :seq
+                           ORDER BY 5 DESC LIMIT :limit"""
+
+CHILD_HISTORY_PAGE_SQL = """SELECT m.id, u.username, m.message, m.timestamp, m.sent_at
+                            FROM messages m JOIN users u ON m.sender_id = u.id
+                            WHERE m.sender_id=:child AND m.is_visible=1
+                            AND (m.sent_at, m.id) < (:sent_at, :id)
+                            UNION ALL
+                            SELECT m.id, u.username, m.message, m.timestamp, m.sent_at
+                            FROM messages m JOIN users u ON m.sender_id = u.id
+                            WHERE m.receiver_id=:child AND m.sender_id<>:child AND m.is_visible=1
+                            AND (m.sent_at, m.id) < (:sent_at, :id)
+                            ORDER BY 5 DESC, 1 DESC LIMIT :limit"""
+
+# Oldest-first rows after the newest one rendered, on the same indexes and
+# keys as the pages, so a refresh costs this conversation's new messages
+# rather than everything sent anywhere since.
+CONVERSATION_SINCE_SQL = """SELECT m.id, u.username, m.message, m.timestamp, m.seq
+                            FROM messages m JOIN users u ON m.sender_id = u.id
+                            WHERE m.sender_id=:user AND m.receiver_id=:contact AND m.is_visible=1
+                            AND m.seq > :seq
+                            UNION ALL
+                            SELECT m.id, u.username, m.message, m.timestamp, m.seq
+                            FROM messages m JOIN users u ON m.sender_id = u.id
+                            WHERE m.sender_id=:contact AND m.receiver_id=:user AND m.is_visible=1
+                            AND m.seq > :seq
+                            ORDER BY 5"""
+
+CHILD_HISTORY_SINCE_SQL = """SELECT m.id, u.username, m.message, m.timestamp, m.sent_at
+                             FROM messages m JOIN users u ON m.sender_id = u.id
+                             WHERE m.sender_id=:child AND m.is_visible=1
+                             AND (m.sent_at, m.id) > (:sent_at, :id)
+                             UNION ALL
+                             SELECT m.id, u.username, m.message, m.timestamp, m.sent_at
+                             FROM messages m JOIN users u ON m.sender_id = u.id
+                             WHERE m.receiver_id=:child AND m.sender_id<>:child AND m.is_visible=1
+                             AND (m.sent_at, m.id) > (:sent_at, :id)
+                             ORDER BY 5, 1"""
+
+MESSAGE_SQL = """SELECT m.id, u.username, m.message, m.timestamp, m.sender_id, m.receiver_id
+                 FROM messages m JOIN users u ON m.sender_id = u.id
+                 WHERE m.id=?"""
+
+# A message between two children of the same guardian is only returned by
+# the first branch. Both branches read their index backwards, highest risk
+# first (unscored last), and are merged without a sort.
+PENDING_MESSAGES_SQL = """SELECT m.id, u1.username, u2.username, m.message, m.timestamp, m.risk, m.signature
+                          FROM messages m
+                          JOIN users u1 ON m.sender_id = u1.id
+                          JOIN users u2 ON m.receiver_id = u2.id
+                          WHERE m.sender_guardian_id=:parent AND m.approved=0
+                          UNION ALL
+                          SELECT m.id, u1.username, u2.username, m.message, m.timestamp, m.risk, m.signature
+                          FROM messages m
+                          JOIN users u1 ON m.sender_id = u1.id
+                          JOIN users u2 ON m.receiver_id = u2.id
+                          WHERE m.receiver_guardian_id=:parent AND m.approved=0
+                          AND m.sender_guardian_id IS NOT :parent
+                          ORDER BY 6 DESC"""
+
+UPDATE_MESSAGE_SQL = "UPDATE messages SET approved=?, is_visible=?, reviewed_at=? WHERE id=?"
+
+INSERT_MESSAGE_SQL = """INSERT INTO messages
+                        (sender_id, receiver_id, message, timestamp, approved, is_visible, sent_at, seq,
+                         filter_version, signature, content_key, sender_guardian_id, receiver_guardian_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                                (SELECT parent_id FROM users WHERE id=?),
+                                (SELECT parent_id FROM users WHERE id=?))"""
+
+NEXT_SEQ_SQL = """INSERT INTO conversations (user_low, user_high, last_seq) VALUES (?, ?, 1)
+                  ON CONFLICT(user_low, user_high) DO UPDATE SET last_seq = last_seq + 1
+                  RETURNING last_seq, risk_window"""
+
+PREVIOUS_SEQ_SQL = """INSERT INTO conversations (user_low, user_high, first_seq) VALUES (?, ?, 0)
+                      ON CONFLICT(user_low, user_high) DO UPDATE SET first_seq = first_seq - 1
+                      RETURNING first_seq"""
+
+UNSEQUENCED_SQL = """SELECT id, sender_id, receiver_id, timestamp FROM messages
+                     WHERE seq IS NULL AND id < ? ORDER BY id DESC LIMIT ?"""
+
+BACKFILL_CLOCK_SQL = "UPDATE messages SET sent_at=?, seq=? WHERE id=?"
+
+LATEST_FILTER_VERSION_SQL = """SELECT version, digest FROM filter_versions
+                               WHERE version = (SELECT MAX(version) FROM filter_versions)"""
+
+INSERT_FILTER_VERSION_SQL = "INSERT INTO filter_versions (digest) VALUES (?)"
+
+# No ORDER BY: rescanned rows leave the range, so each chunk starts where the last one ended
+STALE_MESSAGES_SQL = "SELECT id, message, approved FROM messages WHERE filter_version < ? LIMIT ?"
+
+RESCANNED_SQL = "UPDATE messages SET filter_version=? WHERE id=?"
+
+# The text changes, so its content key no longer describes it and an approval of it is not reused
+RESCAN_HIT_SQL = """UPDATE messages SET message=?, approved=?, is_visible=?, filter_version=?, content_key=NULL
+                    WHERE id=?"""
+
+FAMILY_TERMS_SQL = "SELECT term FROM family_terms WHERE parent_id=?"
+
+INSERT_FAMILY_TERM_SQL = "INSERT OR IGNORE INTO family_terms (parent_id, term) VALUES (?, ?)"
+
+FAMILY_DOMAINS_SQL = "SELECT domain FROM family_domains WHERE parent_id=?"
+
+INSERT_FAMILY_DOMAIN_SQL = "INSERT OR IGNORE INTO family_domains (parent_id, domain) VALUES (?, ?)"
+
+SET_RISK_WINDOW_SQL = "UPDATE conversations SET risk_window=? WHERE user_low=? AND user_high=?"
+
+# One flag for each guardian of the two users
+INSERT_FLAG_SQL = """INSERT INTO conversation_flags (parent_id, user_low, user_high, kinds)
+                     SELECT DISTINCT parent_id, ?, ?, ? FROM users WHERE id IN (?, ?) AND parent_id IS NOT NULL"""
+
+OPEN_FLAGS_SQL = """SELECT f.id, u1.username, u2.username, f.kinds, f.flagged_at
+                    FROM conversation_flags f
+                    JOIN users u1 ON f.user_low = u1.id
+                    JOIN users u2 ON f.user_high = u2.id
+                    WHERE f.parent_id=? AND f.dismissed=0
+                    ORDER BY f.id DESC"""
+
+DISMISS_FLAG_SQL = "UPDATE conversation_flags SET dismissed=1 WHERE id=?"
+
+APPROVED_CONTENT_SQL = "SELECT 1 FROM approved_content WHERE content_key=? AND approved_at >= ?"
+
+REMEMBER_APPROVAL_SQL = """INSERT INTO approved_content (content_key, approved_at)
+                           SELECT content_key, ? FROM messages WHERE id=? AND content_key IS NOT NULL
+                           ON CONFLICT(content_key) DO UPDATE SET approved_at=excluded.approved_at"""
+
+FORGET_APPROVAL_SQL = "DELETE FROM approved_content WHERE content_key=(SELECT content_key FROM messages WHERE id=?)"
+
+EXPIRE_APPROVALS_SQL = "DELETE FROM approved_content WHERE approved_at < ?"
+
+UNSCORED_SQL = "SELECT id, message FROM messages WHERE risk IS NULL AND id > ? ORDER BY id LIMIT ?"
+
+SET_RISK_SQL = "UPDATE messages SET risk=? WHERE id=?"
+
+# The most recent guardian decisions, as training data for the risk model
+REVIEWED_MESSAGES_SQL = """SELECT message, approved FROM messages
+                           WHERE id > (SELECT MAX(id) FROM messages) - ?
+                           AND reviewed_at IS NOT NULL AND approved <> 0"""
+
+PRODUCTION_QUERIES = {
+    "login": LOGIN_SQL,
+    "parent_by_username": PARENT_BY_USERNAME_SQL,
+    "user_id_by_username": USER_ID_BY_USERNAME_SQL,
+    "children": CHILDREN_SQL,
+    "approved_contacts": APPROVED_CONTACTS_SQL,
+    "contact_exists": CONTACT_EXISTS_SQL,
+    "pending_contacts": PENDING_CONTACTS_SQL,
+    "pending_counts": PENDING_COUNTS_SQL,
+    "update_contact": UPDATE_CONTACT_SQL,
+    "conversation_page": CONVERSATION_PAGE_SQL,
+    "child_history_page": CHILD_HISTORY_PAGE_SQL,
+    "conversation_since": CONVERSATION_SINCE_SQL,
+    "child_history_since": CHILD_HISTORY_SINCE_SQL,
+    "message": MESSAGE_SQL,
+    "unsequenced": UNSEQUENCED_SQL,
+    "pending_messages": PENDING_MESSAGES_SQL,
+    "update_message": UPDATE_MESSAGE_SQL,
+    "latest_filter_version": LATEST_FILTER_VERSION_SQL,
+    "stale_messages": STALE_MESSAGES_SQL,
+    "rescanned": RESCANNED_SQL,
+    "rescan_hit": RESCAN_HIT_SQL,
+    "family_terms": FAMILY_TERMS_SQL,
+    "family_domains": FAMILY_DOMAINS_SQL,
+    "set_risk_window": SET_RISK_WINDOW_SQL,
+    "open_flags": OPEN_FLAGS_SQL,
+    "dismiss_flag": DISMISS_FLAG_SQL,
+    "approved_content": APPROVED_CONTENT_SQL,
+    "remember_approval": REMEMBER_APPROVAL_SQL,
+    "forget_approval": FORGET_APPROVAL_SQL,
+    "expire_approvals": EXPIRE_APPROVALS_SQL,
+    "unscored": UNSCORED_SQL,
+    "set_risk": SET_RISK_SQL,
+    "reviewed_messages": REVIEWED_MESSAGES_SQL,
+}
+
+PAGE_SIZE = 50
+
+_NEWEST = 2 ** 63 - 1
+_OLDEST = -2 ** 63
+
+
+def conversation_page(db, user_id, contact_id, before=None, limit=PAGE_SIZE):
+    """Return (messages, cursor) for the visible messages between two users
+
+    Messages are (id, username, message, timestamp, position) rows, oldest
+    first, all older than the before cursor (None for the latest page).
+    Pass the returned cursor back in to fetch the next older page; it is
+    None once the start of the conversation has been reached. The newest
+    row's position is where conversation_since() picks up.
+    """
+    rows = db.fetchall(CONVERSATION_PAGE_SQL, {"user": user_id, "contact": contact_id,
+                                               "seq": _NEWEST if before is None else before,
+                                               "limit": limit})
+    cursor = rows[-1][4] if len(rows) == limit else None
+    return rows[::-1], cursor
+
+
+def child_history_page(db, child_id, before=None, limit=PAGE_SIZE):
+    """Like conversation_page, for everything a child has sent or received"""
+    sent_at, message_id = before or (_NEWEST, _NEWEST)
+    rows = db.fetchall(CHILD_HISTORY_PAGE_SQL, {"child": child_id, "sent_at": sent_at,
+                                                "id": message_id, "limit": limit})
+    cursor = (rows[-1][4], rows[-1][0]) if len(rows) == limit else None
+    return [(*row[:4], (row[4], row[0])) for row in reversed(rows)], cursor
+
+
+def insert_message(db, sender_id, receiver_id, message, approved, is_visible, filter_version=0, watch=None,
+                   signature=None, content_key=None):
+    """Store a message with its send time and next conversation sequence number
+
+    db may be a Database or a WriteQueue. filter_version is the dictionary
+    version the message was filtered with. watch(state) -> (state, kinds)
+    updates the conversation's risk window in the same transaction; when it
+    returns kinds, the guardians of both users get a flag. signature is the
+    message's near-duplicate signature and content_key the digest that
+    approving it records (see approved_before()). Returns the new message id.
+    """
+    return db.run(_store_message, db.clock, sender_id, receiver_id, message, approved, is_visible,
+                  filter_version, watch, signature, content_key)
+
+
+def _store_message(c, clock, sender_id, receiver_id, message, approved, is_visible, filter_version, watch,
+                   signature, content_key):
+    sent_at = clock()
+    pair = (min(sender_id, receiver_id), max(sender_id, receiver_id))
+    c.execute(NEXT_SEQ_SQL, pair)
+    seq, risk_window = c.fetchone()
+    if watch is not None:
+        risk_window, kinds = watch(risk_window)
+        c.execute(SET_RISK_WINDOW_SQL, (risk_window, *pair))
+        if kinds:
+            c.execute(INSERT_FLAG_SQL, (*pair, ", ".join(kinds), sender_id, receiver_id))
+    timestamp = datetime.fromtimestamp(sent_at / 1_000_000).strftime("%Y-%m-%d %H:%M:%S")
+    c.execute(INSERT_MESSAGE_SQL, (sender_id, receiver_id, message, timestamp,
+                                   approved, is_visible, sent_at, seq, filter_version, signature, content_key,
+                                   sender_id, receiver_id))
+    return c.lastrowid
+
+
+def _parse_timestamp_us(timestamp):
+    try:
+        return int(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timestamp() * 1_000_000)
+    except (TypeError, ValueError):
+        return 0
+
+
+def backfill_message_clock(db, chunk_size=5000, stop=None):
+    """Fill sent_at and seq for messages stored before schema version 4
+
+    Works newest-first in short write transactions, so the app keeps running
+    and recent history becomes pageable first. Safe to interrupt: the next
+    run resumes from whatever rows still have no sequence number; setting
+    the optional stop event ends it between chunks. Returns the number of
+    rows updated.
+    """
+    total = 0
+    before = _NEWEST
+    while not (stop and stop.is_set()):
+        with db.write() as c:
+            rows = c.execute(UNSEQUENCED_SQL, (before, chunk_size)).fetchall()
+            for message_id, sender_id, receiver_id, timestamp in rows:
+                c.execute(PREVIOUS_SEQ_SQL, (min(sender_id, receiver_id), max(sender_id, receiver_id)))
+                seq = c.fetchone()[0]
+                c.execute(BACKFILL_CLOCK_SQL, (_parse_timestamp_us(timestamp), seq, message_id))
+        total += len(rows)
+        if len(rows) < chunk_size:
+            return total
+        before = rows[-1][0]
+    return total
+
+
+def filter_version(db, digest):
+    """Return the version number of a dictionary build, numbering it if it is new
+
+    A build only reuses the latest version; going back to an older list
+    gets a fresh number so history is checked against it again.
+    """
+    return db.run(_filter_version, digest)
+
+
+def _filter_version(c, digest):
+    latest = c.execute(LATEST_FILTER_VERSION_SQL).fetchone()
+    if latest and latest[1] == digest:
+        return latest[0]
+    c.execute(INSERT_FILTER_VERSION_SQL, (digest,))
+    return c.lastrowid
+
+
+def rescan_messages(db, scan, version, chunk_size=500, stop=None):
+    """Filter stored messages again when they were scanned before version
+
+    scan(text) returns (masked text, spans), like ContentFilter.filter.
+    Messages with new hits are stored masked and, if they had been approved,
+    hidden and put back in their guardians' review queue. Each chunk commits
+    the new filter_version of its rows, which doubles as the checkpoint: an
+    interrupted run (or the optional stop event) resumes with the rows still
+    behind. Returns the number of messages sent back for review.
+    """
+    requeued = 0
+    while not (stop and stop.is_set()):
+        with db.write() as c:
+            rows = c.execute(STALE_MESSAGES_SQL, (version, chunk_size)).fetchall()
+            for message_id, message, approved in rows:
+                masked, spans = scan(message)
+                if not spans:
+                    c.execute(RESCANNED_SQL, (version, message_id))
+                elif approved == APPROVED:
+                    c.execute(RESCAN_HIT_SQL, (masked, PENDING, 0, version, message_id))
+                    requeued += 1
+                else:
+                    c.execute(RESCAN_HIT_SQL, (masked, approved, 0, version, message_id))
+        if len(rows) < chunk_size:
+            return requeued
+    return requeued
+
+
+def score_messages(db, score, chunk_size=5000, stop=None):
+    """Fill in the risk of every message that has none yet
+
+    score(texts) returns one number per text, like risk.RiskModel.score.
+    Messages are read and scored in chunks outside the write lock, then
+    each chunk's scores are written in one short transaction. Returns the
+    number of messages scored.
+    """
+    total = 0
+    after = 0
+    while not (stop and stop.is_set()):
+        rows = db.fetchall(UNSCORED_SQL, (after, chunk_size))
+        if not rows:
+            return total
+        ids, texts = zip(*rows)
+        scores = [float(risk) for risk in score(texts)]
+        with db.write() as c:
+            c.executemany(SET_RISK_SQL, zip(scores, ids))
+        total += len(rows)
+        after = ids[-1]
+    return total
+
+
+def reviewed_messages(db, window=50_000):
+    """Return (texts, risky flags) for guardian decisions among the last window messages"""
+    rows = db.fetchall(REVIEWED_MESSAGES_SQL, (window,))
+    return [text for text, _ in rows], [approved == REJECTED for _, approved in rows]
+
+
+def family_terms(db, parent_id):
+    """Return the blocked terms a guardian added for their family"""
+    return [term for term, in db.fetchall(FAMILY_TERMS_SQL, (parent_id,))]
+
+
+def family_domains(db, parent_id):
+    """Return the sites a guardian allows links to for their family"""
+    return [domain for domain, in db.fetchall(FAMILY_DOMAINS_SQL, (parent_id,))]
+
+
+def review_messages(db, message_ids, approved):
+    """Approve (and show) or reject several messages in one transaction
+
+    Approved texts are remembered for approved_before(); rejecting a text
+    forgets any earlier approval of it.
+    """
+    status = APPROVED if approved else REJECTED
+    reviewed_at = db.clock()
+    db.run(_review_messages, [(status, int(approved), reviewed_at, message_id) for message_id in message_ids],
+           reviewed_at if approved else None)
+
+
+def _review_messages(c, rows, approved_at):
+    c.executemany(UPDATE_MESSAGE_SQL, rows)
+    if approved_at is None:
+        c.executemany(FORGET_APPROVAL_SQL, [(message_id,) for *_, message_id in rows])
+    else:
+        c.executemany(REMEMBER_APPROVAL_SQL, [(approved_at, message_id) for *_, message_id in rows])
+
+
+def approved_before(db, content_key, max_age):
+    """Whether a guardian approved a message with this content key in the last max_age seconds"""
+    since = db.clock() - int(max_age * 1_000_000)
+    return db.fetchone(APPROVED_CONTENT_SQL, (content_key, since)) is not None
+
+
+def expire_approvals(db, max_age):
+    """Forget approvals older than max_age seconds; returns how many were dropped"""
+    return db.run(_expire_approvals, db.clock() - int(max_age * 1_000_000))
+
+
+def _expire_approvals(c, before):
+    c.execute(EXPIRE_APPROVALS_SQL, (before,))
+    return c.rowcount
+
+
+def open_flags(db, parent_id):
+    """Return (id, user, user, kinds, flagged_at) for a guardian's undismissed conversation flags, newest first"""
+    return db.fetchall(OPEN_FLAGS_SQL, (parent_id,))
+
+
+def pending_counts(db, parent_id):
+    """Return (pending messages, pending contact requests) for a guardian"""
+    return db.fetchone(PENDING_COUNTS_SQL, (parent_id,)) or (0, 0)
+
+
+def pending_messages(db, parent_id):
+    """Return (id, sender, receiver, message, timestamp, risk, signature) rows awaiting a guardian, riskiest first"""
+    return db.fetchall(PENDING_MESSAGES_SQL, {"parent": parent_id})
+
+
+def conversation_since(db, user_id, contact_id, after=None):
+    """Return visible messages between two users after the position after, oldest first
+
+    Rows are shaped like conversation_page's; after is the position of the
+    newest row already shown, or None when there is none.
+    """
+    return db.fetchall(CONVERSATION_SINCE_SQL, {"user": user_id, "contact": contact_id,
+                                                "seq": _OLDEST if after is None else after})
+
+
+def child_history_since(db, child_id, after=None):
+    """Like conversation_since, for everything a child has sent or received"""
+    sent_at, message_id = after or (_OLDEST, _OLDEST)
+    rows = db.fetchall(CHILD_HISTORY_SINCE_SQL, {"child": child_id, "sent_at": sent_at, "id": message_id})
+    return [(*row[:4], (row[4], row[0])) for row in rows]
+
+
+# "SCAN CONSTANT ROW" is the harmless outer row of a SELECT without FROM
+_FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)")
+
+
+def check_query_plans(conn, queries=None):
+    """Return {name: [plan lines]} for every query whose plan contains a SCAN
+
+    An empty result means every query is answered through an index.
+    """
+    failures = {}
+    for name, sql in (queries or PRODUCTION_QUERIES).items():
+        names = re.findall(r":(\w+)", sql)
+        params = dict.fromkeys(names) if names else (None,) * sql.count("?")
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        if any(_FULL_SCAN.match(line) for line in plan):
+            failures[name] = plan
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Migrate a database and check that every production "
+                                                 "query uses an index; exits non-zero on any full scan")
+    parser.add_argument("database", nargs="?", default=":memory:",
+                        help="database file to migrate and check (default: a fresh in-memory database)")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.database)
+    migrate(conn)
+    failures = check_query_plans(conn)
+    for name, plan in failures.items():
+        print(f"{name}: full table scan")
+        for line in plan:
+            print(f"    {line}")
+    print(f"{len(PRODUCTION_QUERIES) - len(failures)}/{len(PRODUCTION_QUERIES)} query plans use an index")
+    sys.exit(1 if failures else 0)
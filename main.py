@@ -1,77 +1,137 @@
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 import sqlite3
-from datetime import datetime
 import hashlib
+import os
 import re
+import threading
+
+import content_filter
+import database
+
+try:
+    import risk
+except ImportError:  # NumPy is optional: without it the review queue is not ranked
+    risk = None
+
+# Word lists ship next to this file, wherever the app is started from
+DICTIONARIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionaries')
 
 class SafeKidMessenger:
-    def __init__(self, root):
+    def __init__(self, root, group_commit=False, approval_reuse=7 * 24 * 3600):
         self.root = root
         self.root.title("SafeKid Messenger")
         self.root.geometry("800x600")
         self.root.configure(bg='#f0f8ff')
         
         # Database setup
-        self.conn = sqlite3.connect('kid_messenger.db', check_same_thread=False)
-        self.c = self.conn.cursor()
+        self.approval_reuse = approval_reuse  # Seconds an approved text stays approved for the same pair; 0 never
+        self.db = database.Database('kid_messenger.db')
         self.setup_database()
+        # Writes go through a group-commit queue when serving many users at once
+        self.writer = database.WriteQueue(self.db) if group_commit else self.db
+        self.directory = database.UserDirectory(self.db)
+        self.setup_content_filter()
+        self.setup_risk_scoring()
         
         # User session
         self.current_user = None
         self.is_parent = False
+        self.family = None  # Guardian id whose word lists apply to this user
         
         # UI components
         self.chat_text = None
         self.contacts_listbox = None
+        self.contact_ids = []  # User id for each contacts_listbox row
+        self.contact_families = {}  # Contact id -> guardian id, or None
+        self.approved_contacts = set()
         self.message_entry = None
         
+        # Paged conversation state
+        self.reset_conversation_state()
+        self.loading_older = False
+        
         # Initialize UI
         self.show_login_screen()
     
     def setup_database(self):
-        """Initialize database tables with proper schema"""
-        # Drop tables if they exist (for clean testing)
-        self.c.execute("DROP TABLE IF EXISTS messages")
-        self.c.execute("DROP TABLE IF EXISTS contacts")
-        self.c.execute("DROP TABLE IF EXISTS users")
-        
-        # Create fresh tables with proper schema
-        self.c.execute('''
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                is_parent INTEGER NOT NULL DEFAULT 0,
-                parent_id INTEGER,
-                FOREIGN KEY(parent_id) REFERENCES users(id)
-            )''')
-        
-        self.c.execute('''
-            CREATE TABLE contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                contact_id INTEGER NOT NULL,
-                approved INTEGER NOT NULL DEFAULT 0,
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                FOREIGN KEY(contact_id) REFERENCES users(id),
-                UNIQUE(user_id, contact_id)
-            )''')
-        
-        self.c.execute('''
-            CREATE TABLE messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER NOT NULL,
-                receiver_id INTEGER NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME NOT NULL,
-                approved INTEGER NOT NULL DEFAULT 0,
-                is_visible INTEGER NOT NULL DEFAULT 0,
-                FOREIGN KEY(sender_id) REFERENCES users(id),
-                FOREIGN KEY(receiver_id) REFERENCES users(id)
-            )''')
-        
-        self.conn.commit()
+        """Bring the database schema up to date without touching existing data"""
+        self.db.migrate()
+        if self.approval_reuse:
+            database.expire_approvals(self.db, self.approval_reuse)
+        # Messages from before schema version 4 get their clock in the background
+        self.stopping = threading.Event()
+        self.backfill_thread = threading.Thread(
+            target=database.backfill_message_clock, args=(self.db,),
+            kwargs={'stop': self.stopping}, daemon=True)
+        self.backfill_thread.start()
+    
+    def setup_content_filter(self):
+        """Load the blocked-term dictionary and keep stored messages checked against it
+        
+        Without the dictionary file the built-in default terms are used.
+        """
+        dictionary = os.path.join(DICTIONARIES, 'blocked_terms.txt')
+        self.content_filter = content_filter.ContentFilter(
+            dictionary=dictionary if os.path.exists(dictionary) else None,
+            versions=lambda digest: database.filter_version(self.writer, digest),
+            fuzzy=True, cache_size=10_000,
+            family_terms=lambda parent_id: database.family_terms(self.db, parent_id),
+            allowed_domains=self.read_word_list(os.path.join(DICTIONARIES, 'allowed_domains.txt')),
+            family_domains=lambda parent_id: database.family_domains(self.db, parent_id))
+        self.content_filter.watch()
+        self.conversation_risk = content_filter.ConversationRisk()
+        self.rescan_thread = threading.Thread(target=self.rescan_history, daemon=True)
+        self.rescan_thread.start()
+    
+    def read_word_list(self, path):
+        """Return the entries of a word list file, or none if it is missing"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                return content_filter.parse_terms(f.read())
+        except FileNotFoundError:
+            return []
+    
+    def rescan_history(self):
+        """Re-check stored messages each time the dictionary gets a new version"""
+        self.content_filter.wait_ready()
+        scanned = None
+        while not self.stopping.is_set():
+            version = self.content_filter.version
+            if version != scanned:
+                database.rescan_messages(self.db, self.content_filter.filter, version, stop=self.stopping)
+                scanned = version
+            self.stopping.wait(5)
+    
+    def setup_risk_scoring(self):
+        """Train the risk model and score new messages in the background, if NumPy is available"""
+        self.scoring_wanted = threading.Event()
+        self.scoring_thread = None
+        if risk is None:
+            return
+        self.risk_model = risk.RiskModel.seeded(*database.reviewed_messages(self.db))
+        self.scoring_thread = threading.Thread(target=self.score_new_messages, daemon=True)
+        self.scoring_thread.start()
+    
+    def score_new_messages(self):
+        """Score unscored messages in batches, woken early whenever one is sent"""
+        while not self.stopping.is_set():
+            self.scoring_wanted.clear()
+            database.score_messages(self.db, self.risk_model.score, stop=self.stopping)
+            self.scoring_wanted.wait(5)
+    
+    def shutdown(self):
+        """Stop background work, flush queued writes and close the database"""
+        self.stopping.set()
+        self.backfill_thread.join()
+        self.rescan_thread.join()
+        if self.scoring_thread is not None:
+            self.scoring_wanted.set()
+            self.scoring_thread.join()
+        self.content_filter.close()
+        if self.writer is not self.db:
+            self.writer.close()
+        self.db.close()
     
     def show_login_screen(self):
         """Display the login/registration screen"""
@@ -104,12 +164,12 @@ class SafeKidMessenger:
         
         hashed_password = self.hash_password(password)
         
-        self.c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, hashed_password))
-        user = self.c.fetchone()
+        user = self.db.fetchone(database.LOGIN_SQL, (username, hashed_password))
         
         if user:
             self.current_user = user
             self.is_parent = bool(user[3])
+            self.family = user[0] if self.is_parent else user[4]
             self.show_main_interface()
         else:
             messagebox.showerror("Error", "Invalid username or password")
@@ -138,8 +198,7 @@ class SafeKidMessenger:
         if not is_parent:
             parent_username = simpledialog.askstring("Register", "Enter parent's username:")
             if parent_username:
-                self.c.execute("SELECT id FROM users WHERE username=? AND is_parent=1", (parent_username,))
-                parent = self.c.fetchone()
+                parent = self.db.fetchone(database.PARENT_BY_USERNAME_SQL, (parent_username,))
                 if parent:
                     parent_id = parent[0]
                 else:
@@ -148,10 +207,9 @@ class SafeKidMessenger:
         
         try:
             hashed_password = self.hash_password(password)
-            self.c.execute(
-                "INSERT INTO users (username, password, is_parent, parent_id) VALUES (?, ?, ?, ?)",
-                (username, hashed_password, int(is_parent), parent_id))
-            self.conn.commit()
+            self.writer.execute(database.INSERT_USER_SQL,
+                            (username, hashed_password, int(is_parent), parent_id))
+            self.directory.invalidate(username)
             messagebox.showinfo("Success", "Registration successful!")
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "Username already exists")
@@ -191,12 +249,14 @@ class SafeKidMessenger:
         self.contacts_listbox.bind('<<ListboxSelect>>', self.load_conversation)
         
         self.load_contacts()
+        self.reset_conversation_state()
         
         # Chat area (right side)
         chat_frame = tk.Frame(main_frame, bg='#ffffff')
         chat_frame.pack(side='right', fill='both', expand=True)
         
-        self.chat_text = tk.Text(chat_frame, state='disabled', wrap='word')
+        self.chat_text = tk.Text(chat_frame, state='disabled', wrap='word',
+                                 yscrollcommand=self.on_chat_scroll)
         self.chat_text.pack(fill='both', expand=True, padx=5, pady=5)
         
         # Message input area
@@ -225,6 +285,17 @@ class SafeKidMessenger:
                 bg='#98fb98').pack(side='left', padx=5)
         tk.Button(control_frame, text="Add Child Account", command=self.add_child_account, 
                 bg='#98fb98').pack(side='left', padx=5)
+        tk.Button(control_frame, text="Block Word", command=self.add_blocked_word, 
+                bg='#98fb98').pack(side='left', padx=5)
+        tk.Button(control_frame, text="Allow Site", command=self.add_allowed_site, 
+                bg='#98fb98').pack(side='left', padx=5)
+        tk.Button(control_frame, text="Risk Alerts", command=self.show_risk_alerts, 
+                bg='#ff9999').pack(side='left', padx=5)
+        
+        flags = database.open_flags(self.db, self.current_user[0])
+        if flags:
+            messagebox.showwarning("Risk Alerts", f"{len(flags)} conversation(s) show warning signs. "
+                                   "Open Risk Alerts to review them.")
     
     def clear_window(self):
         """Clear all widgets from the main window"""
@@ -234,20 +305,33 @@ class SafeKidMessenger:
     def load_contacts(self):
         """Load the user's contact list"""
         self.contacts_listbox.delete(0, tk.END)
+        self.contact_ids = []
+        self.contact_families = {}
+        self.approved_contacts = set()
         
         if self.is_parent:
             # Parents see their children
-            self.c.execute("""SELECT id, username FROM users 
-                            WHERE parent_id=?""", (self.current_user[0],))
-            for child in self.c.fetchall():
-                self.contacts_listbox.insert(tk.END, f"👶 {child[1]}")
+            for child_id, child_username in self.db.fetchall(database.CHILDREN_SQL, (self.current_user[0],)):
+                self.contacts_listbox.insert(tk.END, f"👶 {child_username}")
+                self.contact_ids.append(child_id)
+                self.contact_families[child_id] = self.current_user[0]
+                self.directory.remember(child_username, child_id)
         else:
             # Children see approved contacts
-            self.c.execute("""SELECT u.id, u.username FROM contacts c
-                            JOIN users u ON c.contact_id = u.id
-                            WHERE c.user_id=? AND c.approved=1""", (self.current_user[0],))
-            for contact in self.c.fetchall():
-                self.contacts_listbox.insert(tk.END, contact[1])
+            for contact_id, contact_username, family in self.db.fetchall(database.APPROVED_CONTACTS_SQL,
+                                                                         (self.current_user[0],)):
+                self.contacts_listbox.insert(tk.END, contact_username)
+                self.contact_ids.append(contact_id)
+                self.contact_families[contact_id] = family
+                self.approved_contacts.add(contact_id)
+                self.directory.remember(contact_username, contact_id)
+    
+    def selected_contact_id(self):
+        """Return the user id of the selected contact, or None"""
+        selection = self.contacts_listbox.curselection()
+        if not selection:
+            return None
+        return self.contact_ids[selection[0]]
     
     def add_friend(self):
         """Initiate adding a new friend/contact"""
@@ -255,27 +339,20 @@ class SafeKidMessenger:
         if not friend_username:
             return
             
-        self.c.execute("SELECT id FROM users WHERE username=?", (friend_username,))
-        friend = self.c.fetchone()
+        friend_id = self.directory.lookup(friend_username)
         
-        if not friend:
+        if friend_id is None:
             messagebox.showerror("Error", "User not found")
             return
-            
-        friend_id = friend[0]
         
         # Check if already a contact
-        self.c.execute("""SELECT 1 FROM contacts 
-                        WHERE user_id=? AND contact_id=?""", (self.current_user[0], friend_id))
-        if self.c.fetchone():
+        if self.db.fetchone(database.CONTACT_EXISTS_SQL, (self.current_user[0], friend_id)):
             messagebox.showerror("Error", "Already a contact")
             return
             
         # Add to contacts (pending approval)
         try:
-            self.c.execute("""INSERT INTO contacts (user_id, contact_id, approved)
-                          VALUES (?, ?, ?)""", (self.current_user[0], friend_id, 0))
-            self.conn.commit()
+            self.writer.execute(database.INSERT_CONTACT_SQL, (self.current_user[0], friend_id))
             messagebox.showinfo("Success", "Friend request sent for parental approval")
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "Contact request already exists")
@@ -284,12 +361,7 @@ class SafeKidMessenger:
     
     def show_pending_contacts(self):
         """Display pending contact requests for parent approval"""
-        self.c.execute("""SELECT c.id, u1.username, u2.username 
-                       FROM contacts c
-                       JOIN users u1 ON c.user_id = u1.id
-                       JOIN users u2 ON c.contact_id = u2.id
-                       WHERE u1.parent_id=? AND c.approved=0""", (self.current_user[0],))
-        pending_contacts = self.c.fetchall()
+        pending_contacts = self.db.fetchall(database.PENDING_CONTACTS_SQL, (self.current_user[0],))
         
         if not pending_contacts:
             messagebox.showinfo("Info", "No pending contact requests")
@@ -320,8 +392,8 @@ class SafeKidMessenger:
     
     def process_contact_request(self, contact_id, approved, window):
         """Process a contact approval or rejection"""
-        self.c.execute("UPDATE contacts SET approved=? WHERE id=?", (approved, contact_id))
-        self.conn.commit()
+        status = database.APPROVED if approved else database.REJECTED
+        self.writer.execute(database.UPDATE_CONTACT_SQL, (status, contact_id))
         
         # Close the current window
         window.destroy()
@@ -329,58 +401,38 @@ class SafeKidMessenger:
         messagebox.showinfo("Success", "Contact request processed")
         
         # Reopen if there are more pending requests
-        self.c.execute("""SELECT COUNT(*) FROM contacts c
-                       JOIN users u ON c.user_id = u.id
-                       WHERE u.parent_id=? AND c.approved=0""", (self.current_user[0],))
-        if self.c.fetchone()[0] > 0:
+        if database.pending_counts(self.db, self.current_user[0])[1] > 0:
             self.show_pending_contacts()
     
     def load_conversation(self, event=None):
-        """Load messages for the selected contact"""
+        """Load the latest page of messages for the selected contact"""
         self.chat_text.config(state='normal')
         self.chat_text.delete('1.0', tk.END)
+        self.reset_conversation_state()
         
-        selection = self.contacts_listbox.curselection()
-        if not selection:
+        contact_id = self.selected_contact_id()
+        if contact_id is None:
             return
-            
-        selected_contact = self.contacts_listbox.get(selection[0])
         
         try:
-            if selected_contact.startswith("👶"):
+            if self.is_parent:
                 # Parent viewing child's messages
-                child_username = selected_contact[2:].strip()
-                self.c.execute("SELECT id FROM users WHERE username=?", (child_username,))
-                child_id = self.c.fetchone()[0]
-                
-                query = """SELECT u.username, m.message, m.timestamp 
-                        FROM messages m
-                        JOIN users u ON m.sender_id = u.id
-                        WHERE (m.sender_id=? OR m.receiver_id=?)
-                        AND m.is_visible=1
-                        ORDER BY m.timestamp"""
-                params = (child_id, child_id)
+                child_id = contact_id
+                self.fetch_page = lambda before: database.child_history_page(self.db, child_id, before)
+                self.fetch_new = lambda after: database.child_history_since(self.db, child_id, after)
+                self.chat_members = {child_id}
             else:
                 # Regular conversation
-                self.c.execute("SELECT id FROM users WHERE username=?", (selected_contact,))
-                contact_id = self.c.fetchone()[0]
-                
-                query = """SELECT u.username, m.message, m.timestamp 
-                        FROM messages m
-                        JOIN users u ON m.sender_id = u.id
-                        WHERE ((m.sender_id=? AND m.receiver_id=?)
-                        OR (m.sender_id=? AND m.receiver_id=?))
-                        AND m.is_visible=1
-                        ORDER BY m.timestamp"""
-                params = (self.current_user[0], contact_id, contact_id, self.current_user[0])
+                self.fetch_page = lambda before: database.conversation_page(
+                    self.db, self.current_user[0], contact_id, before)
+                self.fetch_new = lambda after: database.conversation_since(
+                    self.db, self.current_user[0], contact_id, after)
+                self.chat_members = {self.current_user[0], contact_id}
             
-            self.c.execute(query, params)
-            messages = self.c.fetchall()
-            
-            for message in messages:
-                username, msg, timestamp = message
-                display_msg = f"{username} ({timestamp}): {msg}\n"
-                self.chat_text.insert(tk.END, display_msg)
+            messages, self.history_cursor = self.fetch_page(None)
+            if messages:
+                self.refresh_cursor = messages[-1][4]
+            self.chat_text.insert(tk.END, self.format_messages(messages))
                     
         except sqlite3.Error as e:
             messagebox.showerror("Database Error", str(e))
@@ -388,6 +440,76 @@ class SafeKidMessenger:
             self.chat_text.config(state='disabled')
             self.chat_text.yview(tk.END)
     
+    def reset_conversation_state(self):
+        """Forget the paging and refresh cursors of the open conversation"""
+        self.fetch_page = None
+        self.fetch_new = None
+        self.chat_members = set()
+        self.history_cursor = None
+        self.refresh_cursor = None
+    
+    def format_messages(self, messages):
+        """Format (id, username, message, timestamp, ...) rows for the chat view"""
+        return "".join(f"{username} ({timestamp}): {msg}\n"
+                       for _, username, msg, timestamp, *_ in messages)
+    
+    def refresh_conversation(self, approved_ids=()):
+        """Append only the messages that became visible since the last render
+        
+        approved_ids are messages that were just approved. They may be older
+        than the newest rendered row, so each one the refresh did not return
+        is fetched on its own if it belongs here.
+        """
+        if self.fetch_new is None or not self.chat_text.winfo_exists():
+            return
+        
+        try:
+            messages = self.fetch_new(self.refresh_cursor)
+            if messages:
+                self.refresh_cursor = messages[-1][4]
+            fetched = {m[0] for m in messages}
+            for approved_id in sorted(approved_ids, reverse=True):
+                if approved_id not in fetched:
+                    row = self.db.fetchone(database.MESSAGE_SQL, (approved_id,))
+                    if row and self.chat_members <= set(row[4:]):
+                        messages.insert(0, row[:4])
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", str(e))
+            return
+        
+        if not messages:
+            return
+        self.chat_text.config(state='normal')
+        self.chat_text.insert(tk.END, self.format_messages(messages))
+        self.chat_text.config(state='disabled')
+        self.chat_text.yview(tk.END)
+    
+    def on_chat_scroll(self, first, last):
+        """Fetch the next older page once the chat is scrolled to the top"""
+        if float(first) <= 0.0 and self.history_cursor is not None and not self.loading_older:
+            self.loading_older = True
+            self.root.after_idle(self.load_older_messages, self.fetch_page)
+    
+    def load_older_messages(self, fetch_page):
+        """Prepend the page of messages before the oldest one shown"""
+        self.loading_older = False
+        if fetch_page is not self.fetch_page or not self.chat_text.winfo_exists():
+            return  # Another conversation was opened or the window was closed
+        
+        self.chat_text.config(state='normal')
+        try:
+            messages, self.history_cursor = fetch_page(self.history_cursor)
+            # Keep the previous top line in place while text is inserted above it
+            self.chat_text.mark_set('history_top', '1.0')
+            self.chat_text.mark_gravity('history_top', tk.RIGHT)
+            self.chat_text.insert('1.0', self.format_messages(messages))
+            self.chat_text.yview('history_top')
+        except sqlite3.Error as e:
+            self.history_cursor = None
+            messagebox.showerror("Database Error", str(e))
+        finally:
+            self.chat_text.config(state='disabled')
+    
     def send_message(self, event=None):
         """Send a new message with proper approval handling"""
         if not self.is_parent and not self.check_contact_approved():
@@ -398,81 +520,60 @@ class SafeKidMessenger:
         if not message:
             return
             
-        selection = self.contacts_listbox.curselection()
-        if not selection:
+        receiver_id = self.selected_contact_id()
+        if receiver_id is None:
             messagebox.showerror("Error", "Please select a contact")
             return
-            
-        selected_contact = self.contacts_listbox.get(selection[0])
-        
-        # Get receiver ID
-        if selected_contact.startswith("👶"):
-            child_username = selected_contact[2:].strip()
-            self.c.execute("SELECT id FROM users WHERE username=?", (child_username,))
-            receiver_id = self.c.fetchone()[0]
-        else:
-            self.c.execute("SELECT id FROM users WHERE username=?", (selected_contact,))
-            receiver_id = self.c.fetchone()[0]
-        
-        # Apply content filtering
-        message = self.filter_message(message)
         
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Set initial visibility based on sender
-        is_visible = 1 if self.is_parent else 0  # Only visible immediately if sent by parent
+        # Apply content filtering, including both families' own word lists
+        filter_version = self.content_filter.version
+        families = sorted({family for family in (self.family, self.contact_families[receiver_id])
+                           if family is not None})
+        held_links = self.content_filter.held_links(message, families)
+        signals = content_filter.risk_signals(message)
+        message = self.filter_message(message, families)
+        
+        # Set initial visibility based on sender. A parent's link to a site the child's
+        # family has not allowed waits for that guardian too (a child is not their own family).
+        # A text a guardian already approved between these two users is shown at once.
+        to_child = receiver_id not in families
+        is_visible = 1 if self.is_parent and not (held_links and to_child) else 0
+        content_key = self.content_filter.content_key(self.current_user[0], receiver_id, message)
+        if not is_visible and self.approval_reuse:
+            is_visible = int(database.approved_before(self.db, content_key, self.approval_reuse))
         
         try:
-            self.c.execute("""INSERT INTO messages 
-                           (sender_id, receiver_id, message, timestamp, approved, is_visible)
-                           VALUES (?, ?, ?, ?, ?, ?)""",
-                           (self.current_user[0], receiver_id, message, timestamp, is_visible, is_visible))
-            self.conn.commit()
+            database.insert_message(self.writer, self.current_user[0], receiver_id, message,
+                                    is_visible, is_visible, filter_version,
+                                    watch=lambda state: self.conversation_risk.observe(state, signals),
+                                    signature=content_filter.signature(message), content_key=content_key)
             
             self.message_entry.delete(0, tk.END)
+            self.scoring_wanted.set()
             
-            if not self.is_parent:
+            if not is_visible:
                 messagebox.showinfo("Sent", "Message sent for parental approval")
                 # Notify parent if online
                 self.notify_parent()
             
-            self.load_conversation()
+            self.refresh_conversation()
         except sqlite3.Error as e:
             messagebox.showerror("Error", f"Failed to send message: {str(e)}")
     
-    def filter_message(self, message):
+    def filter_message(self, message, families=()):
         """Apply content filtering to messages"""
-        bad_words = ["bad", "hate", "stupid"]  # Should be more comprehensive in production
-        for word in bad_words:
-            if word in message.lower():
-                message = message.replace(word, "***")
-                messagebox.showinfo("Filtered", "Some words were filtered out for safety")
-                break
+        message, spans = self.content_filter.filter(message, families)
+        if spans:
+            messagebox.showinfo("Filtered", "Some words were filtered out for safety")
         return message
     
     def check_contact_approved(self):
         """Check if current contact is approved"""
-        selection = self.contacts_listbox.curselection()
-        if not selection:
-            return False
-            
-        contact_name = self.contacts_listbox.get(selection[0])
-        self.c.execute("""SELECT c.approved FROM contacts c
-                        JOIN users u ON c.contact_id = u.id
-                        WHERE u.username=? AND c.user_id=?""",
-                        (contact_name, self.current_user[0]))
-        result = self.c.fetchone()
-        return result and result[0] == 1
+        return self.selected_contact_id() in self.approved_contacts
     
     def show_pending_messages(self):
         """Display messages pending approval"""
-        self.c.execute("""SELECT m.id, u1.username, u2.username, m.message, m.timestamp
-                       FROM messages m
-                       JOIN users u1 ON m.sender_id = u1.id
-                       JOIN users u2 ON m.receiver_id = u2.id
-                       WHERE (u1.parent_id=? OR u2.parent_id=?) AND m.approved=0""",
-                       (self.current_user[0], self.current_user[0]))
-        pending_messages = self.c.fetchall()
+        pending_messages = database.pending_messages(self.db, self.current_user[0])
         
         if not pending_messages:
             messagebox.showinfo("Info", "No pending messages to review")
@@ -484,39 +585,105 @@ class SafeKidMessenger:
         
         tk.Label(review_window, text="Pending Messages for Approval", font=('Arial', 12)).pack(pady=5)
         
-        for msg in pending_messages:
-            msg_id, sender, receiver, message, timestamp = msg
+        # Near-identical messages between the same two users are reviewed together, and every
+        # distinct text in a group is shown. Messages from before signatures are signed here.
+        signatures = [signature if signature is not None else content_filter.signature(msg[3])
+                      for *msg, signature in pending_messages]
+        pairs = [(sender, receiver) for _, sender, receiver, *_ in pending_messages]
+        for group in content_filter.near_duplicates(signatures, owners=pairs):
+            msg_id, sender, receiver, _, timestamp, _, _ = pending_messages[group[0]]
+            msg_ids = [pending_messages[i][0] for i in group]
+            texts = list(dict.fromkeys(pending_messages[i][3] for i in group))
+            scores = [pending_messages[i][5] for i in group if pending_messages[i][5] is not None]
             frame = tk.Frame(review_window, borderwidth=1, relief='solid')
             frame.pack(fill='x', padx=5, pady=2)
             
-            tk.Label(frame, text=f"ID: {msg_id} | From: {sender} | To: {receiver} | {timestamp}").pack(anchor='w')
-            tk.Label(frame, text=message, wraplength=400, justify='left').pack(anchor='w')
+            spans = [self.content_filter.inspect(text, [self.current_user[0]]) for text in texts]
+            header = f"ID: {msg_id} | From: {sender} | To: {receiver} | {timestamp}"
+            if scores:
+                header += f" | Risk: {max(scores):.0%}"
+            if len(group) > 1:
+                header += f" | {len(group)} similar messages, {len(texts)} different"
+            shared = sorted({kind for found in spans for _, _, kind in found if kind != 'blocked'})
+            if shared:
+                header += f" | Shares: {', '.join(shared)}"
+            tk.Label(frame, text=header).pack(anchor='w')
+            for text, found in zip(texts, spans):
+                self.show_highlighted(frame, text, found)
             
             btn_frame = tk.Frame(frame)
             btn_frame.pack(fill='x')
             
-            tk.Button(btn_frame, text="Approve", 
-                     command=lambda mid=msg_id, w=review_window: self.process_message(mid, 1, w),
+            suffix = f" All ({len(group)})" if len(group) > 1 else ""
+            tk.Button(btn_frame, text="Approve" + suffix, 
+                     command=lambda ids=msg_ids, w=review_window: self.process_messages(ids, 1, w),
                      bg='#98fb98').pack(side='right', padx=2)
-            tk.Button(btn_frame, text="Reject", 
-                     command=lambda mid=msg_id, w=review_window: self.process_message(mid, 0, w),
+            tk.Button(btn_frame, text="Reject" + suffix, 
+                     command=lambda ids=msg_ids, w=review_window: self.process_messages(ids, 0, w),
                      bg='#ff9999').pack(side='right', padx=2)
     
-    def process_message(self, message_id, approved, window):
-        """Process message approval or rejection with proper visibility control"""
+    def show_highlighted(self, parent, message, spans):
+        """Show a message with blocked terms, unlisted links and personal information highlighted"""
+        text = tk.Text(parent, height=max(1, len(message) // 60 + 1), width=60, wrap='word',
+                       borderwidth=0, bg=parent.cget('bg'))
+        text.insert('1.0', message)
+        text.tag_config('blocked', background='#ff9999')
+        text.tag_config('link', background='#add8e6')
+        for kind in content_filter.PII_KINDS:
+            text.tag_config(kind, background='#ffe4a0')
+        for start, end, kind in spans:
+            text.tag_add(kind, f'1.0+{start}c', f'1.0+{end}c')
+        text.configure(state='disabled')
+        text.pack(anchor='w')
+    
+    def show_risk_alerts(self):
+        """List conversations flagged for several kinds of warning signs"""
+        flags = database.open_flags(self.db, self.current_user[0])
+        
+        if not flags:
+            messagebox.showinfo("Info", "No conversations have been flagged")
+            return
+        
+        alerts_window = tk.Toplevel(self.root)
+        alerts_window.title("Risk Alerts")
+        
+        tk.Label(alerts_window, text="Conversations with several warning signs", font=('Arial', 12)).pack(pady=5)
+        
+        for flag_id, user_a, user_b, kinds, flagged_at in flags:
+            frame = tk.Frame(alerts_window, borderwidth=1, relief='solid')
+            frame.pack(fill='x', padx=5, pady=2)
+            
+            tk.Label(frame, text=f"{user_a} and {user_b} | {flagged_at}").pack(anchor='w')
+            tk.Label(frame, text=f"Signs: {kinds.replace('_', ' ')}", fg='#b22222').pack(anchor='w')
+            tk.Button(frame, text="Dismiss",
+                     command=lambda fid=flag_id, w=alerts_window: self.dismiss_flag(fid, w),
+                     bg='#98fb98').pack(side='right', padx=2)
+    
+    def dismiss_flag(self, flag_id, window):
+        """Mark a conversation flag as reviewed"""
+        try:
+            self.writer.execute(database.DISMISS_FLAG_SQL, (flag_id,))
+            window.destroy()
+            if database.open_flags(self.db, self.current_user[0]):
+                self.show_risk_alerts()
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"Failed to dismiss alert: {str(e)}")
+    
+    def process_messages(self, message_ids, approved, window):
+        """Approve or reject a message, or a group of similar ones, with proper visibility control"""
         try:
-            # Update both approval and visibility status together
-            self.c.execute("UPDATE messages SET approved=?, is_visible=? WHERE id=?", 
-                         (approved, approved, message_id))
-            self.conn.commit()
+            # Update approval and visibility of the whole group in one transaction
+            database.review_messages(self.writer, message_ids, approved)
             
             # Close the review window
             window.destroy()
             
-            messagebox.showinfo("Success", "Message processed successfully")
+            count = len(message_ids)
+            messagebox.showinfo("Success", f"{count} messages processed successfully" if count > 1
+                                else "Message processed successfully")
             
             # Refresh conversation if viewing affected chat
-            self.load_conversation()
+            self.refresh_conversation(message_ids if approved else ())
             
             # Reopen review window if more pending messages exist
             if self.has_pending_messages():
@@ -524,22 +691,15 @@ class SafeKidMessenger:
                 
         except sqlite3.Error as e:
             messagebox.showerror("Error", f"Failed to process message: {str(e)}")
-            self.conn.rollback()
     
     def has_pending_messages(self):
         """Check if there are pending messages for review"""
-        self.c.execute("""SELECT COUNT(*) FROM messages m
-                       JOIN users u1 ON m.sender_id = u1.id
-                       JOIN users u2 ON m.receiver_id = u2.id
-                       WHERE (u1.parent_id=? OR u2.parent_id=?) AND m.approved=0""",
-                       (self.current_user[0], self.current_user[0]))
-        return self.c.fetchone()[0] > 0
+        return database.pending_counts(self.db, self.current_user[0])[0] > 0
     
     def notify_parent(self):
         """Notify parent that a new message needs approval"""
         if not self.is_parent:
-            self.c.execute("SELECT id FROM users WHERE parent_id=?", (self.current_user[0],))
-            parent = self.c.fetchone()
+            parent = self.db.fetchone(database.CHILDREN_SQL, (self.current_user[0],))
             if parent:
                 # In a real app, this would trigger a notification
                 pass
@@ -564,16 +724,43 @@ class SafeKidMessenger:
             
         try:
             hashed_password = self.hash_password(child_password)
-            self.c.execute("""INSERT INTO users (username, password, is_parent, parent_id)
-                          VALUES (?, ?, 0, ?)""",
-                          (child_username, hashed_password, self.current_user[0]))
-            self.conn.commit()
+            self.writer.execute(database.INSERT_USER_SQL,
+                            (child_username, hashed_password, 0, self.current_user[0]))
+            self.directory.invalidate(child_username)
             messagebox.showinfo("Success", "Child account added successfully!")
             self.load_contacts()
         except sqlite3.IntegrityError:
             messagebox.showerror("Error", "Username already exists")
+    
+    def add_blocked_word(self):
+        """Add a word to this family's own blocked list"""
+        term = simpledialog.askstring("Block Word", "Word or name to block in your family's messages:")
+        if not term or not term.strip():
+            return
+        
+        try:
+            self.writer.execute(database.INSERT_FAMILY_TERM_SQL, (self.current_user[0], term.strip().lower()))
+            self.content_filter.overlays.invalidate(self.current_user[0])
+            messagebox.showinfo("Success", f"'{term.strip()}' will be filtered from now on")
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"Failed to add word: {str(e)}")
+    
+    def add_allowed_site(self):
+        """Allow links to a site (and its subdomains) in this family's messages"""
+        site = simpledialog.askstring("Allow Site", "Website your children may share links to:")
+        domain = content_filter.domain_host(site or '')
+        if not domain:
+            return
+        
+        try:
+            self.writer.execute(database.INSERT_FAMILY_DOMAIN_SQL, (self.current_user[0], domain))
+            self.content_filter.allowlists.invalidate(self.current_user[0])
+            messagebox.showinfo("Success", f"Links to {domain} will no longer need review")
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"Failed to add site: {str(e)}")
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = SafeKidMessenger(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    app.shutdown()
\ No newline at end of file